@@ -17,7 +17,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import getopt, re, os, sys, errno, time, copy, struct, codecs
+import getopt, re, os, sys, errno, time, copy, struct, codecs, io, threading
 from stat import *
 
 cftypes={}
@@ -260,6 +260,50 @@ class TimedProgressMeter(ProgressMeter):
 			self.nexttime = curtime + 0.06
 			ProgressMeter.update(self, cursize)
 
+class ThreadedProgressMeter(ProgressMeter):
+	#update() only records the position, which a reporter thread draws every interval seconds, so the hashing loops
+	#don't write to the terminal and can keep using their fast paths
+	interval = 0.06
+	def __init__(self, *args, **kw):
+		ProgressMeter.__init__(self, *args, **kw)
+		self.pos = 0
+		self.active = 0
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def init(self, name, size=None, cursize=0):
+		self.lock.acquire()
+		try:
+			ProgressMeter.init(self, name, size, cursize)
+			self.active = 1
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run)
+				self.thread.setDaemon(1)
+				self.thread.start()
+		finally:
+			self.lock.release()
+
+	def update(self, cursize):
+		self.pos = cursize #a single store, safe to do from the hot loop without locking
+
+	def run(self):
+		while 1:
+			time.sleep(self.interval)
+			self.lock.acquire()
+			try:
+				if self.active:
+					ProgressMeter.update(self, self.pos)
+			finally:
+				self.lock.release()
+
+	def cleanup(self):
+		self.lock.acquire()
+		try:
+			self.active = 0
+			ProgressMeter.cleanup(self)
+		finally:
+			self.lock.release()
+
 
 def enverrstr(e):
 	return getattr(e,'strerror',None) or str(e)
@@ -307,6 +351,27 @@ class FileInfoCache:
 	
 	def has_flag(self, fn, flag):
 		return self.getfinfo(fn).has_key(flag)
+
+	def set_stat(self, fn, st):
+		#stat data the caller already has, saves stat'ing the file again
+		self.getfinfo(fn)['stat'] = st
+
+	def getsize(self, fn):
+		st = self.getfinfo(fn).get('stat')
+		if st is None:
+			return os.path.getsize(fn)
+		return st[ST_SIZE]
+
+	def set_wanted(self, fn, names):
+		#digests (see hashers) to compute along with any requested for fn, in the same pass
+		self.getfinfo(fn)['_wanted'] = names
+
+	def forget(self, fn):
+		#drop all info about fn, keeps the cache small when walking huge trees
+		fpath,ftail = os.path.split(fn)
+		pathdata = self.data.get(get_path_key(fpath))
+		if pathdata is not None and pathdata.has_key(ftail):
+			del pathdata[ftail]
 	
 	def getpathcache(self, path):
 		pathkey = get_path_key(path)
@@ -337,23 +402,35 @@ class FileInfoCache:
 		ofinfo.clear()
 
 		
-def getfilesha1(file):
+def getfilechecksums(file, names):
+	#digests of file for all the hasher names, any not cached yet (plus those wanted for file) are computed in a single pass
 	finfo = cache.getfinfo(file)
-	if not finfo.has_key('sha1'):
-		finfo['sha1'],finfo['size'] = _getfilesha1(file)
-	return finfo['sha1'],finfo['size']
+	missing = [name for name in names if not finfo.has_key(name)]
+	if missing:
+		for name in finfo.get('_wanted', ()):
+			if name not in missing and not finfo.has_key(name):
+				missing.append(name)
+		for name in missing:
+			if not hashers.has_key(name):
+				raise CFVValueError, "%s checksums need the %s module"%(name, _hashermodules.get(name, name))
+		if len(missing) == 1 and _getfilehashers.has_key(missing[0]):
+			finfo[missing[0]],finfo['size'] = _getfilehashers[missing[0]](file)
+		else:
+			digests,finfo['size'] = _getfilechecksum(file, multihasher(missing))
+			finfo.update(digests)
+	return dict([(name, finfo[name]) for name in names]),finfo['size']
+
+def getfilechecksum(file, name):
+	return getfilechecksums(file, (name,))[0][name],cache.getfinfo(file)['size']
+
+def getfilesha1(file):
+	return getfilechecksums(file, ('sha1',))[0]['sha1'],cache.getfinfo(file)['size']
 
 def getfilemd5(file):
-	finfo = cache.getfinfo(file)
-	if not finfo.has_key('md5'):
-		finfo['md5'],finfo['size'] = _getfilemd5(file)
-	return finfo['md5'],finfo['size']
+	return getfilechecksums(file, ('md5',))[0]['md5'],cache.getfinfo(file)['size']
 
 def getfilecrc(file):
-	finfo = cache.getfinfo(file)
-	if not finfo.has_key('crc'):
-		finfo['crc'],finfo['size'] = _getfilecrc(file)
-	return finfo['crc'],finfo['size']
+	return getfilechecksums(file, ('crc',))[0]['crc'],cache.getfinfo(file)['size']
 	
 def rename(oldfn, newfn):
 	os.rename(oldfn, newfn)
@@ -614,30 +691,155 @@ try:
 	if sys.version_info[:3] == (2, 4, 2): raise ImportError
 	import mmap
 	if hasattr(mmap, 'ACCESS_READ'):
-		def dommap(fileno, len):#generic mmap.  python2.2 adds ACCESS_* args that work on both nix and win.
+		def dommap(fileno, len, offset=0):#generic mmap.  python2.2 adds ACCESS_* args that work on both nix and win.
 			if len==0: return '' #mmap doesn't like length=0
-			return mmap.mmap(fileno, len, access=mmap.ACCESS_READ)
+			return mmap.mmap(fileno, len, access=mmap.ACCESS_READ, offset=offset)
 	elif hasattr(mmap, 'PROT_READ'):
-		def dommap(fileno, len):#unix mmap.  python default is PROT_READ|PROT_WRITE, but we open readonly.
+		def dommap(fileno, len, offset=0):#unix mmap.  python default is PROT_READ|PROT_WRITE, but we open readonly.
 			if len==0: return '' #mmap doesn't like length=0
-			return mmap.mmap(fileno, len, mmap.MAP_SHARED, mmap.PROT_READ)
+			return mmap.mmap(fileno, len, mmap.MAP_SHARED, mmap.PROT_READ, offset=offset)
 	else:
-		def dommap(fileno, len):#windows mmap.
+		def dommap(fileno, len, offset=0):#windows mmap.
 			if len==0: return ''
-			return mmap.mmap(fileno, len)
+			return mmap.mmap(fileno, len, offset=offset)
 	nommap=0
 except ImportError:
 	nommap=1
 
-_MAX_MMAP = 2**32 - 1
-_FALLBACK_MMAP = 2**31 - 1
+try:
+	if not sys.platform.startswith('linux'): raise ImportError
+	import ctypes, ctypes.util
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (ImportError, OSError):
+	_libc = None
+
+try:
+	fadvise = os.posix_fadvise # python >= 3.3
+	POSIX_FADV_SEQUENTIAL = os.POSIX_FADV_SEQUENTIAL
+	POSIX_FADV_DONTNEED = os.POSIX_FADV_DONTNEED
+except AttributeError:
+	try:
+		if _libc is None: raise ImportError
+		_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+		def fadvise(fd, offset, len, advice):
+			err = _libc.posix_fadvise(fd, offset, len, advice)
+			if err:
+				raise OSError(err, os.strerror(err))
+		POSIX_FADV_SEQUENTIAL = 2
+		POSIX_FADV_DONTNEED = 4
+	except (ImportError, OSError, AttributeError):
+		fadvise = None
+
+#madvise(map, advice) on all of a mapped file, None where not available.  python 2 mmap objects have no madvise(), the
+#address of the mapping comes from the buffer interface
+try:
+	if _libc is None or nommap: raise ImportError
+	_libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+	_asreadbuffer = ctypes.pythonapi.PyObject_AsReadBuffer
+	_asreadbuffer.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ssize_t)]
+	def madvise(map, advice):
+		address, size = ctypes.c_void_p(), ctypes.c_ssize_t()
+		_asreadbuffer(map, ctypes.byref(address), ctypes.byref(size))
+		if _libc.madvise(address, size.value, advice):
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+	MADV_SEQUENTIAL = 2
+except (ImportError, AttributeError):
+	madvise = None
+
+#how files are read for checksumming:
+# default: through the page cache (mmap where possible)
+# fadvise: sequentially, dropping the pages read from the cache again, so a scrub does not evict the working set
+# evict: like fadvise, but dropping the cached pages of the file first, so its data comes from the disk
+# direct: with O_DIRECT into aligned buffers bypassing the cache, falls back to evict where not supported
+READMODES = ('default', 'fadvise', 'evict', 'direct')
+readmode = 'default'
+_READMODE_BLOCK = 2**20
+
+#governor of the reads for checksumming, None to read at full speed.  throttle.file(dev) is called before reading a file
+#on device dev and throttle.read(dev, bytes, seconds) after each block with the time it took, both may sleep.
+throttle = None
+
+def adviseread(fd):
+	#prepare reading the file fd sequentially as readmode says
+	if fadvise is None: return
+	if readmode in ('evict', 'direct'): fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+	fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+def dropread(fd, offset, len):
+	#drop the pages just read from the cache, unless readmode is default
+	if fadvise is not None and readmode != 'default': fadvise(fd, offset, len, POSIX_FADV_DONTNEED)
+
+def openread(file):
+	#io.FileIO of file, opened with O_DIRECT in direct readmode where supported; reads then need page aligned buffers
+	if readmode == 'direct' and hasattr(os, 'O_DIRECT'):
+		try:
+			return io.FileIO(os.open(file, os.O_RDONLY|os.O_DIRECT), 'r')
+		except EnvironmentError, e:
+			if e.errno != errno.EINVAL: raise
+	return io.FileIO(file, 'r')
+
+def _getfilechecksum_readmode(file, hasher):
+	#read in blocks as readmode says, and for the throttle
+	f = openread(file)
+	try:
+		fd = f.fileno()
+		adviseread(fd)
+		t = throttle
+		if t:
+			dev = os.fstat(fd).st_dev
+			t.file(dev)
+		import mmap
+		buf = mmap.mmap(-1, _READMODE_BLOCK) #anonymous maps are page aligned, as O_DIRECT requires
+		m = hasher()
+		s = 0L
+		if stdprogress: progress.init(file, cache.getsize(file))
+		try:
+			while 1:
+				if t: start = time.time()
+				n = f.readinto(buf)
+				if not n: break
+				if t: t.read(dev, n, time.time()-start)
+				m.update(buffer(buf, 0, n))
+				dropread(fd, s, n)
+				s = s+n
+				if stdprogress: progress.update(s)
+		finally:
+			if stdprogress: progress.cleanup()
+	finally:
+		f.close()
+	stats.bytesread = stats.bytesread+s
+	return m.digest(),s
+
+#bytes of a file mapped at a time, a multiple of mmap.ALLOCATIONGRANULARITY
+_MMAP_WINDOW = 2**26
+def _getfilechecksum_mmap(f, s, hasher):
+	#hash file f of size s in place through windows mapped one after another, as mapping large files at once is limited
+	#by the address space (and by C's int type on some python versions)
+	m = hasher()
+	if fadvise: fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+	offset = 0L
+	while offset < s:
+		size = min(_MMAP_WINDOW, s-offset)
+		window = dommap(f.fileno(), size, offset)
+		try:
+			if madvise: madvise(window, MADV_SEQUENTIAL)
+			m.update(buffer(window))
+		finally:
+			window.close()
+		offset = offset+size
+		if stdprogress: progress.update(offset)
+	return m
+
 def _getfilechecksum(file, hasher):
+	if file!='' and (readmode!='default' or throttle):
+		return _getfilechecksum_readmode(file, hasher)
 	if file=='':
 		f=sys.stdin
 	else:
 		f=open(file,'rb')
 	def finish(m,s,f=f,file=file):
-		if stdprogress: progress.init(file)
+		if stdprogress: progress.init(file, file and cache.getsize(file) or None)
 		try:
 			while 1:
 				x=f.read(65536)
@@ -650,20 +852,18 @@ def _getfilechecksum(file, hasher):
 		finally:
 			if stdprogress: progress.cleanup()
 
-	if f==sys.stdin or nommap or stdprogress:
+	if f==sys.stdin or nommap:
 		return finish(hasher(),0L)
 	else:
-		s = os.path.getsize(file)
+		s = cache.getsize(file)
+		if stdprogress: progress.init(file, s)
 		try:
-			if s > _MAX_MMAP:
-				# Work around python 2.[56] problem with md5 of large mmap objects
-				raise OverflowError
-			m = hasher(dommap(f.fileno(), s))
-		except OverflowError:
-			mmapsize = min(s, _FALLBACK_MMAP) #mmap size is limited by C's int type, which even on 64 bit arches is often 32 bits, so we can't use sys.maxint either.  If we get the error, just assume 32 bits. 
-			m = hasher(dommap(f.fileno(), mmapsize))
-			f.seek(mmapsize)
-			return finish(m,mmapsize) #unfortunatly, python's mmap module doesn't support the offset parameter, so we just have to do the rest of the file the old fashioned way.
+			if s > _MMAP_WINDOW:
+				m = _getfilechecksum_mmap(f, s, hasher)
+			else:
+				m = hasher(dommap(f.fileno(), s))
+		finally:
+			if stdprogress: progress.cleanup()
 		stats.bytesread = stats.bytesread+s
 		return m.digest(),s
 
@@ -676,6 +876,66 @@ try:
 except ImportError:
 	from md5 import new as md5_new
 
+try:
+	import zlib
+	_crc32=zlib.crc32
+except ImportError:
+	import binascii
+	_crc32=binascii.crc32
+class CRC32:
+	digest_size = 4
+	def __init__(self, s=''):
+		self.value = _crc32(s)
+	def update(self, s):
+		self.value = _crc32(s, self.value)
+	def digest(self):
+		return struct.pack('>I', self.value & 0xFFFFFFFF)
+
+#hasher constructors by the name their digests are cached under
+hashers = {'sha1': sha_new, 'md5': md5_new, 'crc': CRC32}
+
+#optional hashers, by the module they need.  Others can be plugged in by adding them to hashers.
+_hashermodules = {'blake2b': 'pyblake2', 'xxh64': 'xxhash'}
+try:
+	from hashlib import blake2b as blake2b_new #python >= 3.6
+except ImportError:
+	try:
+		from pyblake2 import blake2b as blake2b_new
+	except ImportError:
+		blake2b_new = None
+if blake2b_new:
+	def _blake2b_new(s='', new=blake2b_new):
+		return new(buffer(s)) #pyblake2 does not take mmaps, but buffers of them
+	hashers['blake2b'] = _blake2b_new
+try:
+	from xxhash import xxh64 as xxh64_new
+	hashers['xxh64'] = xxh64_new
+except ImportError:
+	pass
+
+_MULTIHASH_BLOCK = 2**20
+class MultiHash:
+	#feeds the data to a set of hashers at once, digest() returns them by name
+	def __init__(self, names, s=''):
+		self.hashes = [(name, hashers[name]()) for name in names]
+		if s: self.update(buffer(s))
+	def update(self, s):
+		#large buffers (mmaps) are hashed in blocks, so each block is read from memory once for all hashers
+		if len(s) > _MULTIHASH_BLOCK:
+			for offset in xrange(0, len(s), _MULTIHASH_BLOCK):
+				self.update(buffer(s, offset, _MULTIHASH_BLOCK))
+			return
+		for name, h in self.hashes:
+			h.update(s)
+	def digest(self):
+		return dict([(name, h.digest()) for name, h in self.hashes])
+
+def multihasher(names):
+	#hasher constructor for _getfilechecksum computing all of names in one pass
+	def hasher(s='', names=tuple(names)):
+		return MultiHash(names, s)
+	return hasher
+
 def _getfilesha1(file):
 	return _getfilechecksum(file, sha_new)
 			
@@ -688,6 +948,7 @@ try:
 		stderr.write("old fchksum version installed, using std python modules. please update.\n") #can't use perror yet since config hasn't been done..
 		raise ImportError
 	def _getfilemd5(file):
+		if readmode != 'default' or throttle: return _getfilechecksum(file, md5_new)
 		if stdprogress: progress.init(file)
 		try:
 			c,s=fchksum.fmd5(file, stdprogress and progress.update or None, 0.03)
@@ -696,6 +957,7 @@ try:
 			if stdprogress: progress.cleanup()
 		return c,s
 	def _getfilecrc(file):
+		if readmode != 'default' or throttle: return _getfilechecksum(file, CRC32)
 		if stdprogress: progress.init(file)
 		try:
 			c,s=fchksum.fcrc32d(file, stdprogress and progress.update or None, 0.03)
@@ -704,27 +966,15 @@ try:
 			if stdprogress: progress.cleanup()
 		return c,s
 except ImportError:
-	try:
-		import zlib
-		_crc32=zlib.crc32
-	except ImportError:
-		import binascii
-		_crc32=binascii.crc32
-	class CRC32:
-		digest_size = 4
-		def __init__(self, s=''):
-			self.value = _crc32(s)
-		def update(self, s):
-			self.value = _crc32(s, self.value)
-		def digest(self):
-			return struct.pack('>I', self.value & 0xFFFFFFFF)
-
 	def _getfilemd5(file):
 		return _getfilechecksum(file, md5_new)
 			
 	def _getfilecrc(file):
 		return _getfilechecksum(file, CRC32)
 
+#single digest functions by hasher name, used when only one digest is needed
+_getfilehashers = {'sha1': _getfilesha1, 'md5': _getfilemd5, 'crc': _getfilecrc}
+
 def fcmp(f1, f2):
 	import filecmp
 	return filecmp.cmp(f1, f2, shallow=0)
@@ -1161,6 +1411,76 @@ class MD5(FooSum_Base, MD5_MixIn):
 register_cftype('md5', MD5)
 
 
+#---------- b2sum ----------
+
+class BLAKE2B_MixIn:
+	def do_test_file(self, filename, filecrc):
+		c=getfilechecksum(filename, 'blake2b')[0]
+		if c!=filecrc:
+			return c
+
+class B2SUM(FooSum_Base, BLAKE2B_MixIn):
+	description = 'GNU b2sum'
+	descinfo = 'BLAKE2b,name'
+
+	def auto_chksumfile_match(file, _autorem=re.compile(r'[0-9a-fA-F]{128} [ *].')):
+		l = file.peekline(4096)
+		while l:
+			if l[0] not in ';#':
+				return _autorem.match(l) is not None
+			l = file.peeknextline(4096)
+	auto_chksumfile_match=staticmethod(auto_chksumfile_match)
+
+	auto_filename_match = 'b2$'
+
+	_foosum_rem=re.compile(r'([0-9a-fA-F]{128}) ([ *])([^\r\n]+)[\r\n]*$')
+
+	def make_std_filename(filename):
+		return filename+'.b2'
+	make_std_filename = staticmethod(make_std_filename)
+
+	def make_addfile(self, filename):
+		crc=hexlify(getfilechecksum(filename, 'blake2b')[0])
+		return (crc, -1), '%s *%s\n'%(crc,filename)
+
+register_cftype('b2sum', B2SUM)
+
+
+#---------- xxhsum ----------
+
+class XXH64_MixIn:
+	def do_test_file(self, filename, filecrc):
+		c=getfilechecksum(filename, 'xxh64')[0]
+		if c!=filecrc:
+			return c
+
+class XXH64(FooSum_Base, XXH64_MixIn):
+	description = 'xxhsum (XXH64)'
+	descinfo = 'XXH64,name'
+
+	def auto_chksumfile_match(file, _autorem=re.compile(r'[0-9a-fA-F]{16} [ *].')):
+		l = file.peekline(4096)
+		while l:
+			if l[0] not in ';#':
+				return _autorem.match(l) is not None
+			l = file.peeknextline(4096)
+	auto_chksumfile_match=staticmethod(auto_chksumfile_match)
+
+	auto_filename_match = 'xxh(64)?$'
+
+	_foosum_rem=re.compile(r'([0-9a-fA-F]{16}) ([ *])([^\r\n]+)[\r\n]*$')
+
+	def make_std_filename(filename):
+		return filename+'.xxh64'
+	make_std_filename = staticmethod(make_std_filename)
+
+	def make_addfile(self, filename):
+		crc=hexlify(getfilechecksum(filename, 'xxh64')[0])
+		return (crc, -1), '%s *%s\n'%(crc,filename)
+
+register_cftype('xxh64', XXH64)
+
+
 #---------- bsdmd5 ----------
 
 class BSDMD5(ChksumType, MD5_MixIn):
@@ -2405,7 +2725,7 @@ def printcftypehelp(err):
 stats=Stats()
 config=Config()
 cache=FileInfoCache()
-progress=TimedProgressMeter()
+progress=ThreadedProgressMeter()
 
 
 def main(argv=None):
@@ -27,13 +27,53 @@ import os
 import re
 import codecs
 import pickle
+import sqlite3
 import StringIO
 import time
 import logging
+import json
+import zlib
+import array
+import struct
+import mmap
+import stat
+import threading
+import Queue
+import io
+import multiprocessing
+import collections
+import heapq
+import math
+import hashlib
+import select
+import errno
 
 import cfv
 import binascii
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # backport for python < 3.5
+    except ImportError:
+        scandir = None
+
+try:
+    import fcntl
+except ImportError: # not on windows
+    fcntl = None
+
+# inotify through ctypes, None where it is not available
+try:
+    if not sys.platform.startswith('linux'):
+        raise ImportError
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    _libc.inotify_init, _libc.inotify_add_watch, _libc.inotify_rm_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
 # enable utf8 encoding when piped
 sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout);
 #sys.setdefaultencoding('utf8')
@@ -43,6 +83,77 @@ def formattime(timestamp):
         return None
     return unicode(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)))
 
+# name of a cfv checksum type as registered in cfv.cftypes
+_cftypeNames = dict()
+def cftypeName(cftype):
+    name = _cftypeNames.get(cftype)
+    if name is not None:
+        return name
+    for name, t in cfv.cftypes.iteritems():
+        if t is cftype:
+            _cftypeNames[cftype] = name
+            return name
+    raise MyError(u"Unknown checksum type '{0}'!".format(cftype))
+
+def cftypeByName(name):
+    try:
+        return cfv.cftypes[name]
+    except KeyError:
+        raise MyError(u"Unknown checksum type '{0}'!".format(name))
+
+# checksum: hex digest, time: last verified, type: cfv checksum type,
+# fingerprint: stat data at that time, None if unknown
+WatchEntry = collections.namedtuple('WatchEntry',
+                                    'checksum time type fingerprint')
+
+def _statNs(st, name):
+    ns = getattr(st, name + '_ns', None)
+    if ns is None: # python < 3.3
+        ns = int(round(getattr(st, name) * 1e9))
+    return ns
+
+# (size, mtime_ns, ctime_ns, inode) of a file, changes whenever its
+# content can have changed
+def fingerprint(st):
+    return (st.st_size, _statNs(st, 'st_mtime'), _statNs(st, 'st_ctime'),
+            st.st_ino)
+
+# size of a file according to its watchlist entry, 0 if unknown
+def entrySize(entry):
+    if entry.fingerprint is None:
+        return 0
+    return entry.fingerprint[0]
+
+# the set of paths verified longest ago whose files add up to 'budget' bytes
+def selectOldest(watchlist, budget):
+    """
+    >>> wl = dict((name, WatchEntry('00', t, cfv.SFV, (size, 0, 0, 0)))
+    ...           for name, t, size in [('a', 3., 10), ('b', 1., 10),
+    ...                                 ('c', 2., 10), ('d', 4., 10)])
+    >>> sorted(selectOldest(wl, 15)), sorted(selectOldest(wl, 0))
+    (['b', 'c'], [])
+    """
+    if hasattr(watchlist, 'iteroldest'): # indexed by time
+        selected, total = set(), 0
+        for path, size in watchlist.iteroldest():
+            if total >= budget:
+                break
+            selected.add(path)
+            total += size
+        return selected
+    # max-heap by time of the oldest entries seen so far which add up to
+    # the budget, newer entries are dropped once it is reached without them
+    heap, total = [], 0
+    for path, entry in watchlist.iteritems():
+        if heap and total >= budget and entry.time >= -heap[0][0]:
+            continue
+        size = entrySize(entry)
+        heapq.heappush(heap, (-entry.time, size, path))
+        total += size
+        while heap and total - heap[0][1] >= budget:
+            total -= heapq.heappop(heap)[1]
+    return set(path for negTime, size, path in heap)
+
 # TODO
 def uniqueTemporaryFilename():
     return ("unittestfilename"+str(int(time.time())))
@@ -151,6 +262,1051 @@ class ChecksumFile(object):
         print >>output, unicode(self._timestamp), formattime(self._timestamp)
         return output.getvalue()
 
+# cfv hashers by the mix-in of the checksum types using them
+_digestMixIns = ((cfv.SHA1_MixIn, 'sha1'), (cfv.MD5_MixIn, 'md5'),
+                 (cfv.CRC_MixIn, 'crc'), (cfv.BLAKE2B_MixIn, 'blake2b'),
+                 (cfv.XXH64_MixIn, 'xxh64'))
+
+# name of the cfv hasher computing the digests of a checksum type
+def digestName(cftype):
+    if cftype is ChunkHasher:
+        return ChunkHasher.name
+    for mixIn, name in _digestMixIns:
+        if issubclass(cftype, mixIn):
+            break
+    else:
+        raise MyError(u"Checksum type '{0}' has no file digest!"
+                      .format(cftype.__name__))
+    if name not in cfv.hashers:
+        raise MyError(u"Checksum type '{0}' needs the {1} module!"
+                      .format(cftype.__name__, cfv._hashermodules[name]))
+    return name
+
+# raw digest of a file for the given cfv checksum type
+def fileDigest(filename, cftype):
+    return fileDigests(filename, (cftype,))[cftype]
+
+# digests of a file for several checksum types, read in a single pass
+def fileDigests(filename, cftypes):
+    digests = cfv.getfilechecksums(filename,
+                                   [digestName(cftype) for cftype in cftypes])[0]
+    return dict((cftype, digests[digestName(cftype)]) for cftype in cftypes)
+
+class ChunkHasher(object):
+    """
+    cfv hasher of the chunk manifest of a file: the SHA1 of every chunkSize
+    bytes, digest() returns them concatenated. Used as a checksum type of a
+    HashJob, the manifest is computed in the same pass as the file digest.
+
+    >>> hasher = ChunkHasher('a' * 10, chunkSize = 4)
+    >>> hasher.update('b' * 3)
+    >>> digests = hasher.digest()
+    >>> len(digests) // ChunkHasher.digestSize
+    4
+    >>> digests[40:60] == hashlib.sha1('aabb').digest()
+    True
+    """
+    name = 'chunks'
+    chunkSize = 4 * 2**20
+    digestSize = 20
+
+    def __init__(s, data = '', chunkSize = None):
+        s._chunkSize = chunkSize or s.chunkSize
+        s._digests, s._hash, s._filled = [], hashlib.sha1(), 0
+        if data:
+            s.update(data)
+
+    def update(s, data):
+        offset = 0
+        while offset < len(data):
+            count = min(len(data) - offset, s._chunkSize - s._filled)
+            s._hash.update(buffer(data, offset, count))
+            offset += count
+            s._filled += count
+            if s._filled == s._chunkSize:
+                s._digests.append(s._hash.digest())
+                s._hash, s._filled = hashlib.sha1(), 0
+
+    def digest(s):
+        if s._filled:
+            return ''.join(s._digests) + s._hash.digest()
+        return ''.join(s._digests)
+
+cfv.hashers[ChunkHasher.name] = ChunkHasher
+
+# byte ranges (first, last) of the given chunk indices of a file,
+# adjacent chunks joined
+def chunkRanges(indices, chunkSize, size):
+    """
+    >>> chunkRanges([5, 1, 2], 10, 55)
+    [(10, 29), (50, 54)]
+    """
+    ranges = []
+    for index in sorted(indices):
+        first, last = index * chunkSize, min((index+1) * chunkSize, size) - 1
+        if ranges and ranges[-1][1] + 1 == first:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+    return ranges
+
+# reads 'length' bytes into buf at the position of the raw file fd, as a
+# single read may return fewer (network filesystems, signals); returns the
+# bytes read, fewer only at the end of the file
+def readFully(fd, buf, length):
+    filled = fd.readinto(buf)
+    while filled and filled < length:
+        data = fd.read(length - filled)
+        if not data:
+            break
+        buf[filled:filled + len(data)] = data
+        filled += len(data)
+    return filled
+
+# compares the chunks of a file from index 'start' on with the digests of
+# its manifest, reading 'workers' chunks concurrently. progress(index) is
+# called as all chunks before index are verified. Returns the indices of
+# the chunks not matching, raises EnvironmentError if reading failed.
+def verifyChunks(filename, chunkSize, digests, start = 0, workers = 4,
+                 progress = None):
+    size = ChunkHasher.digestSize
+    count = len(digests) // size
+    todo, results = Queue.Queue(), Queue.Queue()
+    for index in xrange(start, count):
+        todo.put(index)
+    def work():
+        buf = mmap.mmap(-1, chunkSize) # page aligned for O_DIRECT
+        try:
+            with cfv.openread(filename) as fd:
+                cfv.adviseread(fd.fileno())
+                throttle = cfv.throttle
+                st = os.fstat(fd.fileno())
+                dev = st.st_dev
+                while True:
+                    try:
+                        index = todo.get_nowait()
+                    except Queue.Empty:
+                        return
+                    fd.seek(index * chunkSize)
+                    start = time.time()
+                    filled = readFully(fd, buf, min(chunkSize, st.st_size -
+                                                    index * chunkSize))
+                    if throttle:
+                        throttle.read(dev, filled, time.time() - start)
+                    cfv.dropread(fd.fileno(), index * chunkSize, filled)
+                    digest = hashlib.sha1(buffer(buf, 0, filled)).digest()
+                    results.put((index, digest ==
+                                 digests[index*size:(index+1)*size]))
+        except EnvironmentError, e:
+            results.put((None, e))
+    threads = [threading.Thread(target = work)
+               for i in range(min(workers, count - start))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    bad, verified, upTo = [], set(), start
+    try:
+        for i in xrange(count - start):
+            index, ok = _waitFor(results)
+            if index is None:
+                raise ok
+            if not ok:
+                bad.append(index)
+            verified.add(index)
+            if index == upTo:
+                while upTo in verified:
+                    verified.remove(upTo)
+                    upTo += 1
+                if progress is not None:
+                    progress(upTo)
+    finally:
+        while not todo.empty(): # let the workers stop early
+            try:
+                todo.get_nowait()
+            except Queue.Empty:
+                break
+    return sorted(bad)
+
+class TreeEntry(object):
+    """
+    A file found by walkTree(), along with the stat data of its directory
+    entry, symlinks resolved. No stat data if its directory was not listed
+    again, see DirCache.
+    """
+    __slots__ = ('path', 'relpath', 'stat')
+
+    def __init__(s, path, relpath, stat):
+        s.path, s.relpath, s.stat = path, relpath, stat
+
+    @property
+    def size(s):
+        return s.stat.st_size
+
+    @property
+    def mtime(s):
+        return s.stat.st_mtime
+
+    @property
+    def inode(s):
+        return s.stat.st_ino
+
+    @property
+    def device(s):
+        return s.stat.st_dev
+
+# yields (name, stat) of the files and directories in path, following
+# symlinks. With scandir the type comes from the directory entry and each
+# of them costs one stat at most, other entries are skipped without any.
+def _scanDir(path):
+    if scandir is None:
+        for name in os.listdir(path):
+            try:
+                yield name, os.stat(os.path.join(path, name))
+            except OSError: # vanished or dangling symlink
+                continue
+        return
+    for dirEntry in scandir(path):
+        try:
+            if dirEntry.is_dir() or dirEntry.is_file():
+                yield dirEntry.name, dirEntry.stat()
+        except OSError:
+            continue
+
+# remembers a directory by (dev, ino), false if it was visited before
+def _firstVisit(visited, path, st):
+    key = (st.st_dev, st.st_ino)
+    if key in visited:
+        logging.warning(u"Skipping already visited directory '{0}'."
+                        .format(path))
+        return False
+    visited.add(key)
+    return True
+
+# regular expression for a glob pattern of Rules
+def _globRegex(pattern):
+    anchored = '/' in pattern.rstrip('/')
+    pattern = pattern.strip('/')
+    regex, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[' and pattern.find(']', i+2) > 0:
+            end = pattern.find(']', i+2)
+            chars = pattern[i+1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[' + chars + ']')
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    if not anchored: # matches the name at any depth
+        regex.insert(0, '(?:.*/)?')
+    return ''.join(regex)
+
+class Rules(object):
+    """
+    Include and exclude rules for the paths in a tree, compiled into one
+    regular expression each for includes and excludes, so the cost of
+    matching a path does not grow with the number of rules. A path is
+    excluded if an exclude rule matches it and no include rule does, the
+    walk does not descend into excluded directories.
+
+    Patterns are globs: '*' and '?' match within a path component, '**'
+    across them. Without a '/' a glob matches the name at any depth, with a
+    trailing '/' it matches directories only. Patterns starting with 're:'
+    are regular expressions matched against the whole relative path, exact
+    paths are added with literal = True.
+
+    >>> rules = Rules()
+    >>> rules.exclude(u'*.tmp'); rules.exclude(u'cache/')
+    >>> rules.exclude(u're:build/.*\\.o'); rules.include(u'keep.tmp')
+    >>> rules.exclude(u'db/checksum.db', literal = True)
+    >>> [rules.excluded(p) for p in (u'a.tmp', u'x/keep.tmp', u'x/cache',
+    ...                              u'build/a/b.o', u'db/checksum.db')]
+    [True, False, False, True, True]
+    >>> rules.excluded(u'x/cache', isDir = True)
+    True
+    >>> rules.excludedPath(u'x/cache/y.txt')
+    True
+    >>> Rules(list(rules.rules)).excluded(u'a.tmp')
+    True
+    """
+    EXCLUDE = "exclude"
+    INCLUDE = "include"
+
+    # rules: list of (action, pattern, literal) in the order added, it is
+    # updated in place
+    def __init__(s, rules = None):
+        if rules is None:
+            rules = []
+        s._rules = rules
+        s._compile()
+
+    @property
+    def rules(self):
+        return self._rules
+
+    def __len__(s):
+        return len(s._rules)
+
+    # one regular expression matching any of the given ones, None if empty
+    @staticmethod
+    def _combine(regexes):
+        if not regexes:
+            return None
+        return re.compile(u'(?:{0})\\Z'.format(
+            u'|'.join(u'(?:{0})'.format(regex) for regex in regexes)), re.U)
+
+    def _compile(s):
+        # per action: (exact paths, regex for files, regex for directories)
+        s._matchers = dict()
+        for action in (s.EXCLUDE, s.INCLUDE):
+            literals, files, dirs = set(), [], []
+            for ruleAction, pattern, literal in s._rules:
+                if ruleAction != action:
+                    continue
+                if literal:
+                    literals.add(pattern)
+                elif pattern.startswith(u're:'):
+                    files.append(pattern[3:])
+                    dirs.append(pattern[3:])
+                else:
+                    dirs.append(_globRegex(pattern))
+                    if not pattern.endswith(u'/'):
+                        files.append(_globRegex(pattern))
+            s._matchers[action] = (literals, s._combine(files),
+                                   s._combine(dirs))
+
+    def add(s, action, pattern, literal = False):
+        if not literal and pattern.startswith(u're:'):
+            try:
+                re.compile(pattern[3:])
+            except re.error, e:
+                raise MyError(u"Invalid regular expression '{0}': {1}"
+                              .format(pattern[3:], e))
+        rule = (action, pattern, literal)
+        if rule not in s._rules:
+            s._rules.append(rule)
+            s._compile()
+
+    def exclude(s, pattern, literal = False):
+        s.add(s.EXCLUDE, pattern, literal)
+
+    def include(s, pattern, literal = False):
+        s.add(s.INCLUDE, pattern, literal)
+
+    # removes all glob and regex rules, keeps the literal ones
+    def clear(s):
+        s._rules[:] = [rule for rule in s._rules if rule[2]]
+        s._compile()
+
+    def _matches(s, action, relpath, isDir):
+        literals, files, dirs = s._matchers[action]
+        if relpath in literals:
+            return True
+        regex = dirs if isDir else files
+        return regex is not None and regex.match(relpath) is not None
+
+    def excluded(s, relpath, isDir = False):
+        if os.sep != '/':
+            relpath = relpath.replace(os.sep, '/')
+        return (s._matches(s.EXCLUDE, relpath, isDir)
+                and not s._matches(s.INCLUDE, relpath, isDir))
+
+    # like excluded() but also true if a directory above is excluded
+    def excludedPath(s, relpath):
+        if s.excluded(relpath):
+            return True
+        head = os.path.dirname(relpath)
+        while head:
+            if s.excluded(head, isDir = True):
+                return True
+            head = os.path.dirname(head)
+        return False
+
+# splits a directory listing into files and subdirectories,
+# sorted by name if ordered. Paths excluded by rules are left out.
+def _listDir(path, relpath, pattern = None, ordered = False, rules = None):
+    files, subdirs = [], []
+    try:
+        for name, st in _scanDir(path):
+            if stat.S_ISDIR(st.st_mode):
+                if (rules is not None and
+                    rules.excluded(os.path.join(relpath, name), True)):
+                    continue
+                subdirs.append((name, st))
+            elif stat.S_ISREG(st.st_mode):
+                if pattern is not None and pattern.search(name) is None:
+                    continue
+                if (rules is not None and
+                    rules.excluded(os.path.join(relpath, name))):
+                    continue
+                files.append(TreeEntry(os.path.join(path, name),
+                                       os.path.join(relpath, name), st))
+    except OSError, e:
+        logging.warning(u"Could not list directory '{0}': {1}"
+                        .format(path, cfv.enverrstr(e)))
+    if ordered:
+        files.sort(key = lambda treeEntry: treeEntry.relpath)
+        subdirs.sort()
+    return files, subdirs
+
+class DirCache(object):
+    """
+    Reuses the listings of the directories of a tree from the previous walk
+    kept in a DirListings, (mtime_ns, file names, subdirectory names) by
+    relpath. A directory whose mtime did not change still has the same
+    entries, its listing is reused by walkTree() instead of reading it
+    again. The listings of the current walk are put into the DirListings
+    for the next one.
+
+    >>> filename = uniqueTemporaryFilename()+".dirs"
+    >>> listings = DirListings(filename)
+    >>> st = os.stat(os.curdir)
+    >>> cache = DirCache(listings)
+    >>> cache.remember(u'a', st, [u'x'], [u'b'], st.st_mtime + 10)
+    >>> listings.replace()
+    >>> cache = DirCache(listings)
+    >>> cache.lookup(u'a', st)
+    ((u'x',), (u'b',))
+    >>> cache.remember(u'c', st, [], [], st.st_mtime) # may change unnoticed
+    >>> listings.replace()
+    >>> listings.get(u'a') is not None, listings.get(u'c')
+    (True, None)
+    >>> listings.close()
+    >>> os.remove(filename)
+    """
+    # listings of directories modified less than this many seconds before
+    # are not kept, later changes may not alter their mtime
+    racyInterval = 2.0
+
+    def __init__(s, listings):
+        s._listings = listings
+        s.hits = 0
+
+    # (file names, subdirectory names) of a directory with stat data st
+    # if it did not change since the last walk, None otherwise
+    def lookup(s, relpath, st):
+        cached = s._listings.get(relpath)
+        if cached is None:
+            return None
+        mtime, files, subdirs = cached
+        if mtime != _statNs(st, 'st_mtime'):
+            return None
+        s._listings.put(relpath, cached)
+        s.hits += 1
+        return files, subdirs
+
+    # listTime: when the directory was listed
+    def remember(s, relpath, st, files, subdirs, listTime):
+        if st.st_mtime > listTime - s.racyInterval:
+            return
+        s._listings.put(relpath, (_statNs(st, 'st_mtime'), tuple(files),
+                                  tuple(subdirs)))
+
+# walks a directory tree top-down like os.walk(followlinks=True),
+# directories reached again by a symlink are skipped by (dev, ino).
+# With a DirCache, unchanged directories are not listed again, the files
+# in them are yielded without stat data. Paths excluded by rules are
+# skipped, excluded directories are not descended into.
+# relpath: of directory in the tree the rules apply to
+def walkTree(directory, pattern = None, ordered = False, dirCache = None,
+             rules = None, relpath = None):
+    if pattern is not None:
+        pattern = re.compile(pattern)
+    st = os.stat(directory)
+    visited = set([(st.st_dev, st.st_ino)])
+    pending = [(directory, relpath or directory[:0], st)]
+    while pending:
+        path, relpath, st = pending.pop()
+        cached = dirCache is not None and dirCache.lookup(relpath, st)
+        if cached:
+            files, subdirNames = cached
+            if ordered:
+                files, subdirNames = sorted(files), sorted(subdirNames)
+            for name in files:
+                if pattern is not None and pattern.search(name) is None:
+                    continue
+                if (rules is not None and
+                    rules.excluded(os.path.join(relpath, name))):
+                    continue
+                yield TreeEntry(os.path.join(path, name),
+                                os.path.join(relpath, name), None)
+            subdirs = []
+            for name in subdirNames:
+                if (rules is not None and
+                    rules.excluded(os.path.join(relpath, name), True)):
+                    continue
+                try:
+                    subdirs.append((name, os.stat(os.path.join(path, name))))
+                except OSError: # removed since
+                    continue
+        elif dirCache is not None and pattern is None:
+            # the complete listing is cached, the rules may change
+            listTime = time.time()
+            files, subdirs = _listDir(path, relpath, None, ordered)
+            dirCache.remember(relpath, st,
+                              [os.path.basename(treeEntry.relpath)
+                               for treeEntry in files],
+                              [name for name, subSt in subdirs], listTime)
+            if rules is not None:
+                files = [treeEntry for treeEntry in files
+                         if not rules.excluded(treeEntry.relpath)]
+                subdirs = [(name, subSt) for name, subSt in subdirs
+                           if not rules.excluded(os.path.join(relpath, name),
+                                                 True)]
+            for treeEntry in files:
+                yield treeEntry
+        else:
+            files, subdirs = _listDir(path, relpath, pattern, ordered, rules)
+            for treeEntry in files:
+                yield treeEntry
+        subdirs = [(os.path.join(path, name), os.path.join(relpath, name), st)
+                   for name, st in subdirs
+                   if _firstVisit(visited, os.path.join(path, name), st)]
+        pending.extend(reversed(subdirs))
+
+# walks a directory tree like walkTree() but yields the files sorted by
+# pathKey() of their relpath, the order of sortedItems(). Only the listings
+# of the directories on the current path are kept.
+def walkTreeSorted(directory, pattern = None, rules = None):
+    if pattern is not None:
+        pattern = re.compile(pattern)
+    st = os.stat(directory)
+    visited = set([(st.st_dev, st.st_ino)])
+    def listing(path, relpath):
+        files, subdirs = _listDir(path, relpath, pattern, rules = rules)
+        items = [(pathKey(os.path.basename(treeEntry.relpath)), treeEntry)
+                 for treeEntry in files]
+        # the paths below a directory sort like its name followed by '/'
+        items.extend((pathKey(name) + '/', (name, st)) for name, st in subdirs)
+        items.sort(key = lambda item: item[0])
+        return path, relpath, iter(items)
+    pending = [listing(directory, directory[:0])]
+    while pending:
+        path, relpath, items = pending[-1]
+        for key, item in items:
+            if isinstance(item, TreeEntry):
+                yield item
+                continue
+            name, st = item
+            if _firstVisit(visited, os.path.join(path, name), st):
+                pending.append(listing(os.path.join(path, name),
+                                       os.path.join(relpath, name)))
+                break
+        else:
+            pending.pop()
+
+class _DirListing(object):
+    # a directory to be listed by a worker of walkTreeParallel()
+    __slots__ = ('path', 'relpath', 'files', 'subdirs', 'scheduled', 'done')
+
+    def __init__(s, path, relpath):
+        s.path, s.relpath = path, relpath
+        s.files, s.subdirs = None, None
+        s.scheduled = False
+        s.done = threading.Event()
+
+def _waitFor(queueOrEvent):
+    # waiting with a timeout keeps the main thread interruptible
+    while True:
+        if isinstance(queueOrEvent, threading._Event):
+            if queueOrEvent.wait(1.0):
+                return
+            continue
+        try:
+            return queueOrEvent.get(timeout = 1.0)
+        except Queue.Empty:
+            continue
+
+# walks a directory tree like walkTree() but lists up to 'workers'
+# directories concurrently, which hides the latency of slow metadata.
+# At most 'lookahead' listings are scheduled or waiting to be consumed.
+# If ordered, the files come in the same order as from an ordered
+# walkTree(), otherwise in the order the listings complete.
+def walkTreeParallel(directory, workers, pattern = None, ordered = False,
+                     lookahead = None, rules = None):
+    """
+    Listings are dropped as they are consumed, an ordered walk holds the
+    files of a bounded number of directories:
+
+    >>> import gc, shutil
+    >>> testdir = uniqueTemporaryFilename()+"w"
+    >>> for i in range(20):
+    ...     os.makedirs(os.path.join(testdir, str(i)))
+    ...     open(os.path.join(testdir, str(i), "a.txt"), "w").close()
+    >>> held = []
+    >>> for treeEntry in walkTreeParallel(testdir, 2, ordered = True,
+    ...                                   lookahead = 2):
+    ...     held.append(sum(1 for o in gc.get_objects()
+    ...                     if isinstance(o, _DirListing) and o.files))
+    >>> len(held), max(held) <= 3
+    (20, True)
+    >>> shutil.rmtree(testdir)
+    """
+    if pattern is not None:
+        pattern = re.compile(pattern)
+    if lookahead is None:
+        lookahead = 4 * workers
+    todo, finished = Queue.Queue(), Queue.Queue()
+    def work():
+        while True:
+            listing = todo.get()
+            if listing is None:
+                return
+            listing.files, listing.subdirs = _listDir(
+                listing.path, listing.relpath, pattern, ordered, rules)
+            listing.done.set()
+            if not ordered:
+                finished.put(listing)
+    threads = [threading.Thread(target = work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    st = os.stat(directory)
+    visited = set([(st.st_dev, st.st_ino)])
+    def subdirListings(listing):
+        for name, st in listing.subdirs:
+            subdir = os.path.join(listing.path, name)
+            if _firstVisit(visited, subdir, st):
+                yield _DirListing(subdir, os.path.join(listing.relpath, name))
+    try:
+        pending = [_DirListing(directory, directory[:0])]
+        if ordered:
+            # depth-first, the next directories in walk order are listed
+            # in advance; the next one always, so the walk goes on while
+            # listings pushed down by new subdirectories hold the others
+            outstanding = 0 # listings scheduled and not consumed yet
+            while pending:
+                for listing in reversed(pending[-lookahead:]):
+                    if outstanding >= lookahead and listing is not pending[-1]:
+                        break
+                    if not listing.scheduled:
+                        listing.scheduled = True
+                        todo.put(listing)
+                        outstanding += 1
+                listing = pending.pop()
+                outstanding -= 1
+                _waitFor(listing.done)
+                pending.extend(reversed(list(subdirListings(listing))))
+                for treeEntry in listing.files:
+                    yield treeEntry
+        else:
+            inflight = 0
+            while pending or inflight:
+                while pending and inflight < lookahead:
+                    todo.put(pending.pop())
+                    inflight += 1
+                listing = _waitFor(finished)
+                inflight -= 1
+                pending.extend(subdirListings(listing))
+                for treeEntry in listing.files:
+                    yield treeEntry
+    finally:
+        for thread in threads:
+            todo.put(None)
+
+# indices of the blocks of a file checked at the sample verification
+# level: the first, the last and pseudo-random ones chosen by the path,
+# about 'fraction' of the blocks, all of them for small files
+def sampleBlocks(path, size, blockSize, fraction):
+    """
+    >>> sampleBlocks(u'a.bin', 300 * 2**20, 2**20, 0.01)
+    [0, 61, 299]
+    >>> sampleBlocks(u'a.bin', 100, 2**16, 0.01)
+    [0]
+    """
+    count = (size + blockSize - 1) // blockSize
+    wanted = max(2, int(math.ceil(count * fraction)))
+    if wanted >= count:
+        return range(count)
+    blocks = set([0, count - 1])
+    seed = hashlib.sha1(path.encode('utf-8')).digest()
+    i = 0
+    while len(blocks) < wanted:
+        digest = hashlib.sha1(seed + str(i)).digest()
+        blocks.add(int(struct.unpack('<Q', digest[:8])[0] % count))
+        i += 1
+    return sorted(blocks)
+
+# SHA1 over the sampleBlocks() of a file, read as cfv.readmode says
+def sampleDigest(filename, path, size, blockSize, fraction):
+    hasher = hashlib.sha1()
+    buf = mmap.mmap(-1, blockSize) # page aligned for O_DIRECT
+    with cfv.openread(filename) as fd:
+        throttle = cfv.throttle
+        if throttle:
+            dev = os.fstat(fd.fileno()).st_dev
+            throttle.file(dev)
+        for index in sampleBlocks(path, size, blockSize, fraction):
+            fd.seek(index * blockSize)
+            start = time.time()
+            count = readFully(fd, buf, min(blockSize,
+                                           size - index * blockSize))
+            if throttle:
+                throttle.read(dev, count, time.time() - start)
+            hasher.update(buffer(buf, 0, count))
+            cfv.dropread(fd.fileno(), index * blockSize, count)
+    return hasher.digest()
+
+class HashJob(collections.namedtuple('HashJob', 'filename stat entry types')):
+    """
+    A file to be hashed by ChecksumDB.check(), with the stat data of the walk
+    and its watchlist entry, None for new files. All the checksum types are
+    computed in one pass, the first is the type of the entry.
+    """
+    __slots__ = ()
+
+    @property
+    def type(s):
+        return s.types[0]
+
+    # identifies the content hashed for a hardlinked file, paths with the
+    # same key share one digest within a run; None if there is only one link
+    @property
+    def linkKey(s):
+        if s.stat.st_nlink < 2:
+            return None
+        return (s.stat.st_dev, s.stat.st_ino, s.stat.st_size,
+                _statNs(s.stat, 'st_mtime'), s.types)
+
+# ioctl to get the extents of a file on Linux, see linux/fiemap.h
+_FS_IOC_FIEMAP = 0xC020660B
+_fiemapHeader = struct.Struct('=QQIIII')
+_fiemapExtent = struct.Struct('=QQQQQIIII')
+
+# errors of the ioctl if the file system does not support it
+_noFiemapErrors = (errno.EOPNOTSUPP, errno.ENOTTY)
+
+# physical byte offset of the first extent of a file, None if it has none
+# (empty, data inline) or FIEMAP is not available; raises EnvironmentError
+# if the file cannot be opened or the file system does not support FIEMAP,
+# see _noFiemapErrors
+def physicalOffset(filename):
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = (_fiemapHeader.pack(0, 2**64-1, 0, 0, 1, 0)
+               + '\x00' * _fiemapExtent.size)
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        result = fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+    finally:
+        os.close(fd)
+    if _fiemapHeader.unpack_from(result)[3] < 1: # no extents mapped
+        return None
+    return _fiemapExtent.unpack_from(result, _fiemapHeader.size)[1]
+
+# sorts jobs for reading, per device:
+#  walk: as found, physical: by location on disk (FIEMAP) falling back to
+#  inode numbers where it is not available, inode: by inode number
+def scheduleJobs(jobs, order = "walk"):
+    if order == "walk":
+        return jobs
+    if order not in ("inode", "physical"):
+        raise MyError(u"Unknown read order '{0}'!".format(order))
+    noFiemap = set() # devices without FIEMAP support
+    def location(job):
+        dev, offset = job.stat.st_dev, None
+        if order == "physical" and dev not in noFiemap:
+            try:
+                offset = physicalOffset(job.filename)
+            except EnvironmentError, e:
+                if e.errno in _noFiemapErrors:
+                    noFiemap.add(dev)
+                # else vanished or unreadable, let hashing report it
+        if offset is None:
+            return (dev, 1, job.stat.st_ino)
+        return (dev, 0, offset)
+    return sorted(jobs, key = location)
+
+# digests of the file of a job by checksum type, hashing reuses the stat
+# data of the walk
+def hashJob(job):
+    cfv.cache.set_stat(job.filename, job.stat)
+    try:
+        return fileDigests(job.filename, job.types)
+    finally:
+        cfv.cache.forget(job.filename)
+
+class SerialHashEngine(object):
+    """
+    Hashes jobs one after another in the calling thread.
+    run() yields (job, digests, error) in job order, error is the
+    EnvironmentError reading the file failed with, if any.
+    """
+    def run(s, jobs):
+        for job in jobs:
+            try:
+                yield job, hashJob(job), None
+            except EnvironmentError, e:
+                yield job, None, e
+
+    def close(s):
+        pass
+
+# concurrent reads a device is given by default: one for spinning disks,
+# where concurrent reads cause seeks, more for solid state storage
+def defaultConcurrency(device):
+    sysfs = "/sys/dev/block/{0}:{1}".format(os.major(device),
+                                            os.minor(device))
+    for queue in ("queue", "../queue"): # partitions use the parent queue
+        try:
+            with open(os.path.join(sysfs, queue, "rotational")) as fd:
+                return fd.read().strip() == "0" and 4 or 1
+        except EnvironmentError:
+            continue
+    return 1 # unknown, e.g. network file systems
+
+class DeviceHashEngine(object):
+    """
+    Hashes jobs on several devices concurrently. Jobs are queued per
+    st_dev in the order given, each device queue is worked on by as many
+    threads as its concurrency allows. hashlib releases the GIL while
+    hashing, the results are handed back to the calling thread, in the order
+    they complete.
+    """
+    _limits = None
+
+    # limits: device number -> number of concurrent reads
+    # default: for devices not in limits, see defaultConcurrency() if None
+    def __init__(s, limits = None, default = None):
+        s._limits = dict(limits or ())
+        s._default = default
+
+    def concurrency(s, device):
+        if device not in s._limits:
+            s._limits[device] = s._default or defaultConcurrency(device)
+        return s._limits[device]
+
+    def run(s, jobs):
+        queues = collections.OrderedDict()
+        for job in jobs:
+            queues.setdefault(job.stat.st_dev, collections.deque()).append(job)
+        results = Queue.Queue()
+        def work(queue):
+            while True:
+                try:
+                    job = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    results.put((job, hashJob(job), None))
+                except Exception, e: # re-raised by the calling thread
+                    results.put((job, None, e))
+        count = 0
+        for device, queue in queues.iteritems():
+            count += len(queue)
+            for i in range(min(s.concurrency(device), len(queue))):
+                thread = threading.Thread(target = work, args = (queue,))
+                thread.daemon = True
+                thread.start()
+        for i in xrange(count):
+            job, digest, error = _waitFor(results)
+            if error is not None and not isinstance(error, EnvironmentError):
+                raise error
+            yield job, digest, error
+
+    def close(s):
+        pass
+
+class PipelineHashEngine(object):
+    """
+    Reads files in reader threads into a bounded set of reusable buffers,
+    while hasher threads hash the buffers filled before. Reading and hashlib
+    both release the GIL, so I/O and hashing overlap. With a single reader
+    the files are read one after another, keeping one disk streaming
+    sequentially. Results are yielded in the order the files complete.
+    """
+    # readers: number of files read concurrently
+    # hashers: number of files hashed concurrently, at least 'readers'
+    #          so that every file being read is also being hashed
+    # buffered: bytes of the buffers, in blocks of bufferSize
+    # Files are read as cfv.readmode says, the buffers are anonymous maps
+    # and so page aligned for O_DIRECT.
+    def __init__(s, readers = 1, hashers = None, buffered = 64 * 2**20,
+                 bufferSize = 2**20):
+        s._readers = readers
+        s._hashers = max(hashers or 2, readers)
+        s._bufferSize = bufferSize
+        s._buffers = max(buffered // bufferSize, 2)
+
+    def run(s, jobs):
+        jobs = list(jobs)
+        free = Queue.Queue()
+        for i in range(s._buffers):
+            free.put(mmap.mmap(-1, s._bufferSize))
+        todo, files, results = Queue.Queue(), Queue.Queue(), Queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        def read():
+            while True:
+                try:
+                    job = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                # files are hashed in the order they are started
+                chunks = Queue.Queue()
+                files.put((job, chunks))
+                try:
+                    with cfv.openread(job.filename) as fd:
+                        cfv.adviseread(fd.fileno())
+                        throttle = cfv.throttle
+                        if throttle:
+                            throttle.file(job.stat.st_dev)
+                        offset = 0
+                        while True:
+                            buf = free.get()
+                            if buf is None: # the results are not wanted
+                                break
+                            start = time.time()
+                            count = fd.readinto(buf)
+                            if not count:
+                                free.put(buf)
+                                break
+                            if throttle:
+                                throttle.read(job.stat.st_dev, count,
+                                              time.time() - start)
+                            cfv.dropread(fd.fileno(), offset, count)
+                            offset += count
+                            chunks.put((buf, count))
+                    chunks.put(None)
+                except EnvironmentError, e:
+                    chunks.put(e)
+        def hash():
+            while True:
+                item = files.get()
+                if item is None:
+                    return
+                job, chunks = item
+                chunk = ()
+                try:
+                    names = [digestName(cftype) for cftype in job.types]
+                    hasher = cfv.multihasher(names)()
+                    while True:
+                        chunk = chunks.get()
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, EnvironmentError):
+                            raise chunk
+                        buf, count = chunk
+                        hasher.update(buffer(buf, 0, count))
+                        free.put(buf)
+                    digests = hasher.digest()
+                    results.put((job, dict((cftype, digests[name])
+                                           for cftype, name
+                                           in zip(job.types, names)), None))
+                except Exception, e: # re-raised by the calling thread
+                    # hand the buffers of the rest of the file back to the
+                    # readers waiting for them
+                    while (chunk is not None and
+                           not isinstance(chunk, EnvironmentError)):
+                        if chunk:
+                            free.put(chunk[0])
+                        chunk = chunks.get()
+                    results.put((job, None, e))
+        threads = ([threading.Thread(target = read)
+                    for i in range(min(s._readers, len(jobs)))] +
+                   [threading.Thread(target = hash)
+                    for i in range(min(s._hashers, len(jobs)))])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in xrange(len(jobs)):
+                job, digests, error = _waitFor(results)
+                if (error is not None and
+                    not isinstance(error, EnvironmentError)):
+                    raise error
+                yield job, digests, error
+        finally:
+            # on an error or when the caller stops early, the readers start
+            # no more files and stop waiting for buffers
+            while True:
+                try:
+                    todo.get_nowait()
+                except Queue.Empty:
+                    break
+            for thread in threads:
+                free.put(None)
+                files.put(None)
+
+    def close(s):
+        pass
+
+# reads in the worker processes of ProcessHashEngine are throttled by
+# the engine
+def _initHashProcess():
+    cfv.throttle = None
+
+# hashes a job sent by ProcessHashEngine in a worker process,
+# returns (digests, error)
+def _hashInProcess(args):
+    filename, st, types = args
+    try:
+        return hashJob(HashJob(filename, st, None, types)), None
+    except EnvironmentError, e:
+        return None, e
+
+class ProcessHashEngine(object):
+    """
+    Hashes jobs in a pool of worker processes, for storage faster than a
+    single core can hash. Results are yielded in the order of the jobs.
+    At most 'inflight' bytes of files and a few jobs per worker are handed
+    out ahead of the result yielded next. A cfv.throttle is applied to
+    whole files as they are handed out.
+    """
+    # workers: number of processes, the number of cores by default
+    # inflight: bytes of the files being hashed or waiting to be yielded
+    def __init__(s, workers = None, inflight = 256 * 2**20):
+        s._workers = workers or multiprocessing.cpu_count()
+        s._inflight = inflight
+        # started before the walk may start threads, paths sent are absolute
+        s._pool = multiprocessing.Pool(s._workers, _initHashProcess)
+
+    @staticmethod
+    def _result(job, result):
+        while not result.ready(): # stays interruptible
+            result.wait(1.0)
+        digests, error = result.get()
+        return job, digests, error
+
+    def run(s, jobs):
+        pending, inflight = collections.deque(), 0
+        for job in jobs:
+            if cfv.throttle:
+                cfv.throttle.file(job.stat.st_dev)
+                cfv.throttle.read(job.stat.st_dev, job.stat.st_size)
+            pending.append((job, s._pool.apply_async(_hashInProcess,
+                ((os.path.abspath(job.filename), job.stat, job.types),))))
+            inflight += job.stat.st_size
+            while pending and (inflight > s._inflight
+                               or len(pending) > 4 * s._workers):
+                job, result = pending.popleft()
+                inflight -= job.stat.st_size
+                yield s._result(job, result)
+        while pending:
+            job, result = pending.popleft()
+            yield s._result(job, result)
+
+    def close(s):
+        s._pool.terminate()
+        s._pool.join()
+
 # TODO: create test checksum file skeleton class 
 class ChecksumDB(object):
     """
@@ -159,138 +1315,694 @@ class ChecksumDB(object):
     >>> while os.path.isdir(testdir): testdir = uniqueTemporaryFilename()+"d"
     >>> os.mkdir(testdir)
     >>> db = ChecksumDB(testdir, ".*\.sha")
+
+    check() returns to the working directory, relative paths stay valid:
+
+    >>> with open(os.path.join(testdir, "bla.txt"), "w") as f: f.write("bla")
+    >>> db.check()
+    >>> db.store(testdir + ".db")
+    >>> os.path.isfile(testdir + ".db")
+    True
+    >>> os.remove(testdir + ".db")
     >>> if os.path.isdir(testdir):
     ...     shutil.rmtree(testdir)
     """
     _directory = None
     _watchlist = None
-    _excludes = None # which files not to monitor
+    _rules = None # which files not to monitor, the list of Rules
+    _matcher = None
     _checkInterval = float(3600*24 * 14)
+    # files to hash are collected and scheduled in batches of this size
+    jobBatch = 100000
+    # chunks of a file verified concurrently against its chunk manifest
+    chunkWorkers = 4
+    # Progress of a check(), None to not report any
+    progress = None
     # for store/load consistency tests
     _count = None
+    # storage format and file the DB was loaded from or stored to last
+    _format = "pickle"
+    _filename = None
+    # the DB reflects all changes of the tree before this time
+    _scanTime = None
+    # name of the checksum type of new entries, see defaultType
+    _defaultType = None
 
     @property
     def directory(self):
         return self._directory
 
-    def __init__(self, directory, pattern):
+    @property
+    def watchlist(self):
+        return self._watchlist
+
+    @property
+    def rules(self):
+        if self._matcher is None:
+            if self._rules is None: # loaded from an older version
+                self._rules = []
+            self._matcher = Rules(self._rules)
+        return self._matcher
+
+    # cfv checksum type new and modified files get, sha1 unless chosen
+    # for the tree
+    @property
+    def defaultType(self):
+        return cftypeByName(self._defaultType or 'sha1')
+
+    @defaultType.setter
+    def defaultType(self, cftype):
+        digestName(cftype) # fails for types without file digests
+        self._defaultType = cftypeName(cftype)
+
+    @property
+    def checkInterval(self):
+        return self._checkInterval
+
+    @property
+    def format(self):
+        return self._format
+
+    def __init__(self, directory, pattern = None, rules = None):
+        if isinstance(directory, str): # walk with unicode paths
+            directory = directory.decode(sys.getfilesystemencoding())
         directory = os.path.abspath(directory)
         if not os.path.isdir(directory):
             raise MyError(u"Provided directory '{0}' does not exist!"
                          .format(directory))
 
         self._directory = directory
-        self._watchlist = dict()
-        self._excludes = set()
+        self._watchlist = CompactWatchlist()
+        self._matcher = rules or Rules()
+        self._rules = self._matcher.rules
+        if pattern is None:
+            return
 
         # add all checksum files within the current directory
-        for fn in self.treeFiles(pattern):
-            match = pattern.search(fn)
-            if match is None:
-                continue
-            fullname = os.path.join(path,fn)
-            checksumFile = ChecksumFile(fullname)
+        for treeEntry in self.treeFiles(pattern):
+            checksumFile = ChecksumFile(treeEntry.path)
             self.addFromFile(checksumFile)
 
-    def exclude(self, pattern):
-        self.excludes.add(pattern)
+    def __getstate__(s):
+        # pickle a compact watchlist, regardless of the storage backend in use
+        state = s.__dict__.copy()
+        state.pop('_matcher', None)
+        state.pop('progress', None) # threads and locks do not pickle
+        state.pop('_dirCache', None) # kept by older versions, see DirListings
+        if not isinstance(s._watchlist, CompactWatchlist):
+            state['_watchlist'] = CompactWatchlist(s._watchlist.iteritems())
+        return state
 
-    def treeFiles(self, pattern = None):
+    # pattern: see Rules, an exact relative path if literal
+    def exclude(self, pattern, literal = False):
+        self.rules.exclude(pattern, literal)
+
+    def include(self, pattern, literal = False):
+        self.rules.include(pattern, literal)
+
+    # walkers: number of directories listed concurrently
+    # ordered: walk in reproducible order
+    # dirCache: skip listing unchanged directories, see walkTree()
+    def treeFiles(self, pattern = None, walkers = 1, ordered = False,
+                  dirCache = None):
         if not os.path.isdir(self.directory):
-            return
-        if pattern is not None:
-            pattern = re.compile(pattern)
-        for (path, dirnames, filenames) in os.walk(self.directory,
-                                                   followlinks=True):
-            for fn in filenames:
-                if pattern is not None and pattern.search(fn) is None:
-                    continue
-                fullname = os.path.join(path,fn)
-                yield fullname
+            return iter(())
+        if dirCache is not None:
+            return walkTree(self.directory, pattern, ordered, dirCache,
+                            self.rules)
+        if walkers > 1:
+            return walkTreeParallel(self.directory, walkers, pattern, ordered,
+                                    rules = self.rules)
+        return walkTree(self.directory, pattern, ordered, rules = self.rules)
 
     # filename: file to add checksum for
-    # type: cfv checksum type (e.g. cfv.SHA1())
-    def _updateEntry(s, filename, type):
+    # type: cfv checksum type (e.g. cfv.SHA1)
+    # st: stat data of the file before hashing
+    # digest: of the file for that type, if known already
+    def _updateEntry(s, filename, type, st = None, digest = None):
         if filename is None or type is None:
             return
-        if not hasattr(s, 'checksumTypes') or not hasattr(s, 'currentTime'):
+        if not hasattr(s, 'currentTime'):
             return
-        checksumType = s.checksumTypes[type]
-        if checksumType is None:
-            return
-        (newChecksum, filesize), dat = checksumType.make_addfile(filename)
-        s.watchlist[filename] = (newChecksum, s.currentTime, type)
-        logging.info(u"NEW: '{0}' '{1}'".format(filename, s.watchlist[filename][0]))
+        if digest is None:
+            digest = fileDigest(filename, type)
+        newChecksum = binascii.b2a_hex(digest)
+        s.watchlist[filename] = WatchEntry(newChecksum, s.currentTime, type,
+                                           st and fingerprint(st))
+        logging.info(u"NEW: '{0}' '{1}'".format(filename, newChecksum))
         s.newFiles.append((newChecksum, filename))
+        s._record(Journal.NEW, filename, s.watchlist[filename])
+
+    def _record(s, kind, filename, entry):
+        if getattr(s, 'journal', None) is not None:
+            s.journal.record(kind, filename, entry)
+
+    # apply the results of an interrupted run recorded in the journal,
+    # returns the files done already
+    def _replay(s, journal):
+        done = set()
+        startTime, records = journal.replay()
+        if startTime is not None:
+            s.currentTime = startTime
+        for kind, filename, entry in records:
+            done.add(filename)
+            if kind in (Journal.NEW, Journal.OK):
+                s.watchlist[filename] = entry
+            if kind == Journal.NEW:
+                s.newFiles.append((entry.checksum, filename))
+            elif kind == Journal.MISMATCH:
+                s.mismatchFiles.append((entry.checksum, filename))
+            elif kind == Journal.CHANGED:
+                s.changedFiles.append((entry.checksum, filename))
+        logging.info(u"Resuming run from {0}, {1} files done already."
+                     .format(formattime(startTime), len(done)))
+        return done
+
+    # the files to verify in a rolling scrub run, about 1/parts of the bytes
+    # in the DB, those verified longest ago
+    def rollingSelection(s, parts):
+        watchlist = s.watchlist
+        if hasattr(watchlist, 'totalBytes'):
+            total = watchlist.totalBytes()
+        else:
+            total = sum(entrySize(entry) for path, entry in watchlist.iteritems())
+        selected = selectOldest(watchlist, total / float(parts))
+        logging.info(u"Rolling scrub, verifying {0} files of about {1:.1f} "
+                     u"of {2:.1f} MiB in total."
+                     .format(len(selected), total / float(parts) / 2**20,
+                             total / 2.**20))
+        return selected
+
+    # the files to check instead of walking the tree if the changes since
+    # the last run were recorded by watchTree(): those changed and those due
+    # for verification. Paths which do not exist anymore go to 'missing'.
+    def _trackedFiles(s, records, scrub, missing):
+        paths, trees = [], set()
+        for kind, relpath in records:
+            if kind == DirtySet.FILE:
+                paths.append(relpath)
+            elif kind == DirtySet.TREE and relpath not in trees:
+                trees.add(relpath)
+                path = os.path.join(s.directory, relpath)
+                if not os.path.isdir(path) or s.rules.excludedPath(relpath):
+                    continue
+                for treeEntry in walkTree(path, rules = s.rules,
+                                          relpath = relpath):
+                    yield treeEntry
+        due = s.currentTime - s.checkInterval
+        for path, entry in s.watchlist.iteritems():
+            if scrub is not None:
+                scheduled = path in scrub
+            else:
+                scheduled = entry.time <= due
+            if scheduled:
+                paths.append(path)
+            elif trees: # anything below a removed directory is gone
+                head = os.path.dirname(path)
+                while head and head not in trees:
+                    head = os.path.dirname(head)
+                if head:
+                    paths.append(path)
+        for relpath in paths:
+            if s.rules.excludedPath(relpath):
+                continue
+            path = os.path.join(s.directory, relpath)
+            try:
+                st = os.stat(path)
+            except OSError:
+                missing.append(relpath)
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield TreeEntry(path, relpath, st)
+            else:
+                missing.append(relpath)
+
+    # a HashJob for a file found by the walk if it has to be hashed,
+    # None if it can be skipped
+    # entry: of the file in the watchlist, None if new
+    def _classify(s, treeEntry, entry, scrub = None):
+        filename = treeEntry.relpath
+        if treeEntry.stat is None: # in a directory unchanged since last walk
+            if entry is not None:
+                if scrub is not None:
+                    due = filename in scrub
+                else:
+                    due = entry.time+s.checkInterval <= s.currentTime
+                if not due and s.level != "sample":
+                    return None
+            try:
+                treeEntry.stat = os.stat(treeEntry.path)
+            except OSError:
+                return None
+        if entry is None:
+            return HashJob(filename, treeEntry.stat, None,
+                           s._jobTypes(None, treeEntry.stat))
+        logging.debug(u"found")
+        unchanged = (entry.fingerprint == fingerprint(treeEntry.stat))
+        # below the full level, unchanged files are checked by their stat
+        # data only, or by samples of their content, whenever verified last
+        if unchanged and s.level == "meta":
+            return None
+        if unchanged and s.level == "sample":
+            return HashJob(filename, treeEntry.stat, entry,
+                           s._jobTypes(entry, treeEntry.stat))
+        # ignore if recently tested and not touched since
+        if scrub is not None:
+            if unchanged and filename not in scrub:
+                return None
+        elif unchanged and entry.time+s.checkInterval > s.currentTime:
+            return None
+        return HashJob(filename, treeEntry.stat, entry,
+                       s._jobTypes(entry, treeEntry.stat))
+
+    # checksum types to compute for a file with the given entry: those of
+    # the entry and of a migration, the type new entries get for new files,
+    # and the chunk manifest for large files
+    def _jobTypes(s, entry, st):
+        newType = s.migrate or s.defaultType
+        if entry is None or entry.type is newType:
+            types = (newType,)
+        elif s.migrate is None:
+            types = (entry.type,)
+        else:
+            types = (entry.type, newType)
+        if s.chunks is not None and st.st_size >= s.chunks.minSize:
+            types += (ChunkHasher,)
+        return types
+
+    # pairs the files of a walkTreeSorted() with their watchlist entries,
+    # None for new files, in a single pass over both. Paths of the watchlist
+    # not found go to 'deleted'.
+    def _mergeTree(s, treeEntries, deleted):
+        items = sortedItems(s.watchlist)
+        item = next(items, None)
+        for treeEntry in treeEntries:
+            key = pathKey(treeEntry.relpath)
+            while item is not None and pathKey(item[0]) < key:
+                deleted.append(item[0])
+                item = next(items, None)
+            if item is not None and pathKey(item[0]) == key:
+                yield treeEntry, item[1]
+                item = next(items, None)
+            else:
+                yield treeEntry, None
+        while item is not None:
+            deleted.append(item[0])
+            item = next(items, None)
+
+    # hash a batch of jobs in the given order, see scheduleJobs()
+    # hardlinks of an inode are hashed once, see HashJob.linkKey
+    # unchanged files with a chunk manifest are verified against it instead,
+    # at the sample level by their sample digest
+    def _runJobs(s, jobs, order = "walk", engine = None):
+        if engine is None:
+            engine = SerialHashEngine()
+        if s.progress is not None:
+            s.progress.begin()
+        unique, links, chunked, sampled = [], dict(), [], []
+        for job in jobs:
+            digest = s._sampleDigest(job)
+            if digest is not None:
+                sampled.append((job, digest))
+                continue
+            manifest = s._chunkManifest(job)
+            if manifest is not None:
+                chunked.append((job, manifest))
+                continue
+            key = job.linkKey
+            if key is None:
+                unique.append(job)
+            elif key in s.linkDigests:
+                s.linkBytesSaved += job.stat.st_size
+                s._applyOutcome(job, s.linkDigests[key], None)
+                s._done(job)
+            elif key in links:
+                s.linkBytesSaved += job.stat.st_size
+                links[key].append(job)
+            else:
+                unique.append(job)
+                links[key] = []
+        for job, digests, error in engine.run(scheduleJobs(unique, order)):
+            key = job.linkKey
+            if key is not None and error is None:
+                s.linkDigests[key] = digests
+            s._applyOutcome(job, digests, error)
+            s._done(job)
+            for link in links.get(key, ()):
+                s._applyOutcome(link, digests, error)
+                s._done(link)
+        for job, manifest in chunked:
+            s._checkChunks(job, manifest)
+            s._done(job)
+        for job, digest in sampled:
+            s._checkSample(job, digest)
+            s._done(job)
+
+    def _done(s, job):
+        if s.progress is not None:
+            s.progress.add(job.stat.st_size)
+
+    # bytes of the files due for verification by their entries, or of those
+    # in 'scrub' if given; new and modified files come on top
+    def _dueBytes(s, scrub):
+        due = s.currentTime - s.checkInterval
+        total = 0
+        for path, entry in s.watchlist.iteritems():
+            if scrub is not None:
+                scheduled = path in scrub
+            else:
+                scheduled = entry.time <= due
+            if scheduled:
+                total += entrySize(entry)
+        return total
+
+    # the sample digest to check the file of a job against at the sample
+    # level, if it is unchanged since its entry was computed; None if it
+    # has to be verified in full, which stores a sample digest
+    def _sampleDigest(s, job):
+        if (s.level != "sample" or s.samples is None or job.entry is None
+            or job.entry.fingerprint != fingerprint(job.stat)):
+            return None
+        return s.samples.get(job.filename, job.entry.checksum,
+                             job.stat.st_size)
+
+    # verify an unchanged file by the blocks sampled from it; its entry
+    # stays due for full verification as before. A file failing is hashed
+    # in full, which confirms and reports the mismatch.
+    def _checkSample(s, job, digest):
+        try:
+            if sampleDigest(job.filename, job.filename, job.stat.st_size,
+                            s.samples.blockSize,
+                            s.samples.fraction) == digest:
+                s.sampledFiles += 1
+                return
+        except EnvironmentError, e:
+            logging.error(u"Could not read '{0}': {1}"
+                          .format(job.filename, cfv.enverrstr(e)))
+            return
+        logging.warning(u"Sampled blocks of '{0}' did not match, hashing it "
+                        u"in full.".format(job.filename))
+        for job, digests, error in SerialHashEngine().run([job]):
+            s._applyOutcome(job, digests, error)
+            if (error is None and
+                s.watchlist[job.filename].checksum == job.entry.checksum):
+                # the content is fine, the stored samples are not
+                s._putSample(job.filename, job.stat, replace = True)
+
+    # store the sample digest of a file along with its entry, unless it is
+    # stored already or replace is set
+    def _putSample(s, filename, st, replace = False):
+        if s.samples is None or filename not in s.watchlist:
+            return
+        checksum = s.watchlist[filename].checksum
+        if replace or s.samples.get(filename, checksum, st.st_size) is None:
+            s.samples.put(filename, checksum, st.st_size,
+                          sampleDigest(filename, filename, st.st_size,
+                                       s.samples.blockSize,
+                                       s.samples.fraction))
+
+    # the chunk manifest to verify the file of a job against, if it is
+    # unchanged since its entry was computed along with the manifest;
+    # None if it has to be hashed as a whole
+    def _chunkManifest(s, job):
+        if (s.chunks is None or job.entry is None
+            or job.types != (job.type, ChunkHasher)
+            or job.entry.fingerprint != fingerprint(job.stat)):
+            return None
+        manifest = s.chunks.get(job.filename)
+        if (manifest is None or manifest.checksum != job.entry.checksum
+            or manifest.size != job.stat.st_size):
+            return None
+        return manifest
+
+    # verify an unchanged file chunk by chunk, reporting the byte ranges
+    # which differ; continues where an interrupted run stopped within the
+    # check interval
+    def _checkChunks(s, job, manifest):
+        filename, entry = job.filename, job.entry
+        start, since = 0, s.currentTime
+        if (manifest.verified is not None
+            and manifest.verified[1] + s.checkInterval > s.currentTime):
+            start, since = manifest.verified
+            logging.info(u"Continuing to verify '{0}' at byte {1}."
+                         .format(filename, start * manifest.chunkSize))
+        saved = [start]
+        def progress(verified): # every 16 chunks
+            if verified - saved[0] >= 16:
+                s.chunks.progress(filename, verified, since)
+                saved[0] = verified
+        try:
+            bad = verifyChunks(filename, manifest.chunkSize, manifest.digests,
+                               start, s.chunkWorkers, progress)
+            s.chunks.progress(filename, None)
+            s.chunkFiles += 1
+            if not bad:
+                entry = entry._replace(time = s.currentTime,
+                                       fingerprint = fingerprint(job.stat))
+                s.watchlist[filename] = entry
+                s._record(Journal.OK, filename, entry)
+                s._putSample(filename, job.stat)
+                return
+            ranges = chunkRanges(bad, manifest.chunkSize, manifest.size)
+            logging.warning(u"Checksum for '{0}' did not match, bytes {1} "
+                            u"differ.".format(filename, u", ".join(
+                                u"{0}-{1}".format(*r) for r in ranges)))
+            s.mismatchFiles.append((entry.checksum, filename))
+            s._record(Journal.MISMATCH, filename, entry)
+            newType = s.migrate or s.defaultType
+            digests = fileDigests(filename, (newType, ChunkHasher))
+            s._updateEntry(filename, newType, job.stat, digests[newType])
+            s._putManifest(filename, job.stat, digests)
+            s._putSample(filename, job.stat)
+        except EnvironmentError, e:
+            logging.error(u"Could not read '{0}': {1}"
+                          .format(filename, cfv.enverrstr(e)))
+
+    # drop the chunk manifests of files which do not exist anymore, are
+    # excluded now or have no entry, so a file created later at the same
+    # path is never checked against one of them
+    def _pruneManifests(s, deleted):
+        gone = set(deleted)
+        for path in s.chunks.paths():
+            if (path in gone or path not in s.watchlist
+                or s.rules.excludedPath(path)):
+                s.chunks.remove(path)
+        s.chunks.commit()
+
+    # store the chunk manifest computed along with the entry of a file
+    def _putManifest(s, filename, st, digests):
+        if ChunkHasher in digests and filename in s.watchlist:
+            s.chunks.put(filename, s.watchlist[filename].checksum,
+                         st.st_size, ChunkHasher.chunkSize,
+                         digests[ChunkHasher])
+
+    # apply the digests of a job, or report the error reading it failed with
+    def _applyOutcome(s, job, digests, error):
+        if error is None:
+            try:
+                s._applyResult(job, digests)
+            except EnvironmentError, e:
+                error = e
+        if error is not None:
+            logging.error(u"Could not read '{0}': {1}"
+                          .format(job.filename, cfv.enverrstr(error)))
+
+    # compare the digest of a hashed file with its entry and update the DB
+    def _applyResult(s, job, digests):
+        filename, entry = job.filename, job.entry
+        digest = digests[job.type]
+        if entry is None: # not in s.watchlist
+            s._updateEntry(filename, job.type, job.stat, digest)
+            s._putManifest(filename, job.stat, digests)
+            s._putSample(filename, job.stat)
+            return
+        newFingerprint = fingerprint(job.stat)
+        newType = s.migrate or s.defaultType
+        newDigest = digests.get(newType)
+        if digest == binascii.a2b_hex(entry.checksum):
+            #logging.info(u"OK: '{0}'".format(filename))
+            if s.migrate is not None and entry.type is not s.migrate:
+                entry = WatchEntry(binascii.b2a_hex(newDigest), s.currentTime,
+                                   s.migrate, newFingerprint)
+                s.migrated += 1
+            else:
+                entry = entry._replace(time = s.currentTime,
+                                       fingerprint = newFingerprint)
+            s.watchlist[filename] = entry
+            s._record(Journal.OK, filename, entry)
+        elif entry.fingerprint in (newFingerprint, None):
+            # content differs although the file was not touched
+            logging.warning(u"Checksum for '{0}' did not match."
+                            .format(filename))
+            s.mismatchFiles.append((entry.checksum, filename))
+            s._record(Journal.MISMATCH, filename, entry)
+            s._updateEntry(filename, newType, job.stat, newDigest)
+        else: # modified on purpose
+            logging.info(u"Checksum for '{0}' changed along with "
+                         u"the file.".format(filename))
+            s.changedFiles.append((entry.checksum, filename))
+            s._record(Journal.CHANGED, filename, entry)
+            s._updateEntry(filename, newType, job.stat, newDigest)
+        s._putManifest(filename, job.stat, digests)
+        s._putSample(filename, job.stat)
 
-    def check(s):
+    # journal: results are written to it as they come in
+    # resume: replay the journal of an interrupted run first
+    # walkers, ordered: see treeFiles()
+    # rolling: verify 1/rolling of the DB, the rest by stat data only,
+    #          instead of everything not verified within checkInterval
+    # order: in which files are read, see scheduleJobs()
+    # engine: hashes the files, e.g. DeviceHashEngine, serially by default
+    # dirty: DirtySet of a watch daemon, replaces the walk if complete
+    # prune: DirListings of the last walk, directories whose mtime did not
+    #        change are not listed again, files in them are verified as
+    #        scheduled, see DirCache
+    # merge: walk the tree in path order and merge it with the DB sorted the
+    #        same way, instead of keeping the set of all paths in memory
+    # migrate: checksum type to convert the entries verified to, new and
+    #          modified files get it as well
+    # chunks: ChunkManifests kept for large files, unchanged files with one
+    #         are verified chunk by chunk, see _checkChunks()
+    # level: how unchanged files are verified, full: hashed as scheduled,
+    #        sample: all of them by samples of their content, see
+    #        _checkSample(), meta: by stat data only
+    # samples: SampleDigests kept for the sample level
+    def check(s, journal = None, resume = False, walkers = 1, ordered = False,
+              rolling = None, order = "inode", engine = None, dirty = None,
+              prune = False, merge = False, migrate = None, chunks = None,
+              level = "full", samples = None):
         # traverse the filesystem and lookup each visited file in the DB
         # faster on disk (?) than random picking of files
         logging.info(u"Starting check ..")
         visited = set()
+        done = set()
         s.currentTime = time.time()
-        s.checksumTypes = { cfv.SHA1: cfv.SHA1() } # default type for creating
         s.newFiles = []
         s.mismatchFiles = []
-        cfv.chdir(s.dirname)
-        for filename in s.treeFiles():
-            filename = os.path.relpath(filename, s.dirname)
-            logging.debug(filename)
-            visited.add(filename)
-
-            if filename in s.watchlist:
-                logging.debug(u"found")
-                oldChecksum, oldTime, oldType = s.watchlist[filename]
-
-                # ignore if recently tested
-                if oldTime+s.checkInterval > s.currentTime:
-                    #continue
-                    pass
-
-                # get checksum algorithm instance from cfv
-                checksumType = None
-                if oldType in s.checksumTypes:
-                    checksumType = s.checksumTypes[oldType]
-                else:
-                    checksumType = oldType()
-                    s.checksumTypes[oldType] = checksumType
-
-                # calc checksum and compare 
-                retval = checksumType.test_file(filename, binascii.a2b_hex(oldChecksum))
-                if retval is not None: # crc mismatch
-                    logging.warning(u"Checksum for '{0}' did not match.".format(filename))
-                    s.mismatchFiles.append((oldChecksum, filename))
-                    s._updateEntry(filename, cfv.SHA1)
-                else:
-                    #logging.info(u"OK: '{0}'".format(filename))
-                    pass
-
-            elif filename not in s.excludes: # not in s.watchlist
-                s._updateEntry(filename, cfv.SHA1)
+        s.changedFiles = []
+        s.linkDigests = dict()
+        s.linkBytesSaved = 0
+        s.migrate, s.migrated = migrate, 0
+        s.chunks, s.chunkFiles = chunks, 0
+        s.level, s.samples, s.sampledFiles = level, samples, 0
+        s.journal = journal
+        scrub = None
+        if rolling:
+            scrub = s.rollingSelection(rolling)
+        if s.progress is not None and level == "full":
+            s.progress.total = s._dueBytes(scrub)
+        if journal is not None:
+            if resume and journal.exists():
+                done = s._replay(journal)
+            journal.open(s.currentTime, append = bool(done))
+        tracked, missing, dirCache = False, [], None
+        if dirty is not None:
+            records, tracked = dirty.claim(s._scanTime)
+        s._scanTime = s.currentTime
+        cfv.chdir(s.directory)
+        try:
+            merged = merge and not tracked
+            if tracked:
+                logging.info(u"Checking {0} changes recorded by watch instead "
+                             u"of the whole tree.".format(len(records)))
+                treeEntries = s._trackedFiles(records, scrub, missing)
+            elif merged:
+                treeEntries = walkTreeSorted(s.directory, rules = s.rules)
+            elif prune:
+                dirCache = DirCache(prune)
+                treeEntries = s.treeFiles(walkers = walkers, ordered = ordered,
+                                          dirCache = dirCache)
+            else:
+                treeEntries = s.treeFiles(walkers = walkers, ordered = ordered)
+            if merged:
+                pairs = s._mergeTree(treeEntries, missing)
+            else:
+                pairs = ((treeEntry, s.watchlist.get(treeEntry.relpath))
+                         for treeEntry in treeEntries)
+            jobs = []
+            for treeEntry, entry in pairs:
+                filename = treeEntry.relpath
+                logging.debug(filename)
+                if not merged: # paths are unique in a merge
+                    if filename in visited:
+                        continue
+                    visited.add(filename)
+                if filename in done:
+                    continue
+                job = s._classify(treeEntry, entry, scrub)
+                if job is None:
+                    continue
+                jobs.append(job)
+                if len(jobs) >= s.jobBatch:
+                    s._runJobs(jobs, order, engine)
+                    jobs = []
+            s._runJobs(jobs, order, engine)
 
-        deleted = s.watchlist.viewkeys() - visited
-        logging.info(u"{0} files do not exist".format(len(deleted)))
+            if journal is not None:
+                journal.close()
+            s.journal = None
+            if dirCache is not None:
+                logging.info(u"{0} unchanged directories not listed again."
+                             .format(dirCache.hits))
+            if tracked:
+                deleted = sorted(set(fn for fn in missing if fn not in visited
+                                     and fn in s.watchlist))
+            elif merged:
+                deleted = [fn for fn in missing
+                           if not s.rules.excludedPath(fn)]
+            else:
+                deleted = [fn for fn in s.watchlist if fn not in visited
+                           and not s.rules.excludedPath(fn)]
+            logging.info(u"{0} files do not exist".format(len(deleted)))
+            if s.linkBytesSaved:
+                logging.info(u"{0:.1f} MiB of hardlinked files not read again."
+                             .format(s.linkBytesSaved / 2.**20))
+            s.linkDigests = None
+            if s.migrate is not None:
+                logging.info(u"Migrated {0} entries to {1}."
+                             .format(s.migrated, cftypeName(s.migrate)))
+            if s.chunkFiles:
+                logging.info(u"{0} files verified by their chunk manifest."
+                             .format(s.chunkFiles))
+            if s.sampledFiles:
+                logging.info(u"{0} files verified by sampled blocks."
+                             .format(s.sampledFiles))
+            if s.chunks is not None:
+                s._pruneManifests(deleted)
+            s.chunks = s.samples = None
 
-        logging.info(u"done.")
-        for checksum, filename in s.newFiles:
-            logging.info(u"NEW: '{0}' '{1}'".format(checksum, filename))
-        for checksum, filename in s.mismatchFiles:
-            logging.warning(u"MISMATCH: '{0}' '{1}'".format(checksum, filename))
-        for filename in deleted:
-            logging.info(u"DELETED: '{0}'".format(filename))
+            logging.info(u"done.")
+            for checksum, filename in s.newFiles:
+                logging.info(u"NEW: '{0}' '{1}'".format(checksum, filename))
+            for checksum, filename in s.changedFiles:
+                logging.info(u"CHANGED: '{0}' '{1}'"
+                             .format(checksum, filename))
+            for checksum, filename in s.mismatchFiles:
+                logging.warning(u"MISMATCH: '{0}' '{1}'"
+                                .format(checksum, filename))
+            for filename in deleted:
+                logging.info(u"DELETED: '{0}'".format(filename))
+        finally:
+            # back to the directory relative paths to load and store from
+            cfv.cdup()
 
-    def store(s, outfile):
+    def store(s, outfile, format = None):
         outfile = os.path.abspath(outfile)
         dirname = os.path.dirname(outfile)
         if not os.path.isdir(dirname):
             raise MyError(u"Directory for database file '{0}' does not exist!"
                          .format(dirname))
+        if format is None:
+            format = s.format
+        if format not in dbFormats:
+            raise MyError(u"Unknown database format '{0}'!".format(format))
         s._count = len(s.watchlist)
         if s.empty():
             raise MyError("Checksum DB is empty, nothing to save.")
-        with open(outfile, 'w') as fd:
-            pickle.dump(s, fd)
-        logging.info("Saved {0} entries.".format(len(s.watchlist)))
+        loadFunc, storeFunc = dbFormats[format]
+        storeFunc(s, outfile)
+        s._format, s._filename = format, outfile
+        logging.info("Saved {0} entries.".format(s._count))
 
     def isValid(s):
         if s._count == len(s.watchlist):
@@ -303,21 +2015,36 @@ class ChecksumDB(object):
         if not os.path.isfile(filename):
             raise MyError(u"Database file '{0}' does not exist!"
                          .format(filename))
-        with open(filename, 'r') as fd:
-            db = pickle.load(fd)
+        format = detectFormat(filename)
+        loadFunc, storeFunc = dbFormats[format]
+        db = loadFunc(filename)
         if not db.isValid():
-            raise MyError("Loading DB file '{0}' failed!".format(infile.name))
-        relname = os.path.relpath(filename, db.dirname)
+            raise MyError("Loading DB file '{0}' failed!".format(filename))
+        db._format, db._filename = format, filename
+        relname = os.path.relpath(filename, db.directory)
         if not relname.startswith(u'..'):
             # infile is part of monitored directory tree
-            db.exclude(relname)
+            db.exclude(relname, literal = True)
+            db.exclude(Journal.filenameFor(relname), literal = True)
+            chunksname = ChunkManifests.filenameFor(relname)
+            db.exclude(chunksname, literal = True)
+            db.exclude(chunksname + u"-journal", literal = True)
+            samplesname = SampleDigests.filenameFor(relname)
+            db.exclude(samplesname, literal = True)
+            db.exclude(samplesname + u"-journal", literal = True)
+            dirsname = DirListings.filenameFor(relname)
+            db.exclude(dirsname, literal = True)
+            db.exclude(dirsname + u"-journal", literal = True)
+            dirtyname = DirtySet.filenameFor(relname)
+            for suffix in (u"", u".claimed", u".lock"): # see DirtySet
+                db.exclude(dirtyname + suffix, literal = True)
         return db
 
     def empty(s):
         return len(s.watchlist) <= 0
 
     def __str__(s):
-        return u"{0} ({1})".format(s.dirname, len(s.watchlist))
+        return u"{0} ({1})".format(s.directory, len(s.watchlist))
 
     def addFromFile(s, checksumFile):
         if checksumFile is None:
@@ -328,10 +2055,17 @@ class ChecksumDB(object):
         newType = checksumFile.checksumType
         for filename, newChecksum in checksumFile.filelist:
             # getting absolute filenames here, making them local to DB.dirname
-            filename = os.path.relpath(filename, s.dirname)
+            filename = os.path.relpath(filename, s.directory)
             logging.debug(filename)
-            if filename in s.watchlist:  # resolve conflicts
-                oldChecksum, oldTime, oldType = s.watchlist[filename]
+            try:
+                binascii.a2b_hex(newChecksum)
+            except (TypeError, binascii.Error):
+                logging.warning(u"Skipping '{0}': malformed checksum '{1}'"
+                                .format(filename, newChecksum))
+                continue
+            entry = s.watchlist.get(filename)
+            if entry is not None:  # resolve conflicts
+                oldChecksum, oldTime, oldType, oldFingerprint = entry
 #                logging.info(type)
                 # TODO: convert checksums to integer for comparison?
                 if oldChecksum == newChecksum: # ignore identical checksums
@@ -346,43 +2080,1878 @@ class ChecksumDB(object):
                                          oldChecksum, formattime(oldTime)))
                     continue
 
-            s.watchlist[filename] = (newChecksum, newTime, newType)
+            s.watchlist[filename] = WatchEntry(newChecksum, newTime, newType,
+                                               None)
         logging.info("done.")
 
-## commands ##
+class Journal(object):
+    """
+    Append-only log of the results of a ChecksumDB.check() run. Each line
+    carries its own CRC, so a line torn by a crash is detected on replay.
+    The file is synced to disk at periodic checkpoints.
 
-def doctest(dummy):
-    import doctest
-    doctest.testmod()
+    >>> filename = uniqueTemporaryFilename()+".journal"
+    >>> journal = Journal(filename)
+    >>> journal.open(1.0)
+    >>> journal.record(Journal.NEW, u'bla.txt',
+    ...                WatchEntry('40c6f45b5673a3cc023eb175ea9e8c4e496c3217',
+    ...                           1.0, cfv.SHA1, (5, 10**18, 10**18, 42)))
+    >>> journal.close()
+    >>> with open(filename, 'a') as fd:
+    ...     fd.write('0badc0de\t["NEW", "blub') # torn last line
+    >>> startTime, records = journal.replay()
+    >>> startTime, [(kind, fn, entry.type.__name__, entry.fingerprint)
+    ...              for kind, fn, entry in records]
+    (1.0, [(u'NEW', u'bla.txt', 'SHA1', (5, 1000000000000000000, 1000000000000000000, 42))])
 
-def verify(args):
-    print "verify"
-    if not hasattr(args, 'filename'):
-        return
+    Resuming appends after the last intact line, the torn one is dropped:
 
-    db = ChecksumDB.load(args.filename)
-    print "Loaded checksums for {0}.".format(db)
-    db.check()
-    db.store(args.filename) # replace with updated db
+    >>> journal.open(1.0, append = True)
+    >>> journal.record(Journal.NEW, u'blub.bin',
+    ...                WatchEntry('d41d8cd98f00b204e9800998ecf8427e',
+    ...                           2.0, cfv.MD5, None))
+    >>> journal.close()
+    >>> [fn for kind, fn, entry in journal.replay()[1]]
+    [u'bla.txt', u'blub.bin']
+    >>> journal.remove()
+    >>> journal.exists()
+    False
+    """
+    START = u"START"
+    CHECKPOINT = u"CHECKPOINT"
+    OK = u"OK"
+    NEW = u"NEW"
+    MISMATCH = u"MISMATCH"
+    CHANGED = u"CHANGED"
+    # sync to disk after this many records or seconds, whatever comes first
+    checkpointRecords = 1000
+    checkpointSeconds = 30.0
 
-# parses existing checksum files and generates a database from them
-# TODO: process checksum files in parallel
-def create(args):
-    if (   not hasattr(args, 'directory')
-        or not hasattr(args, 'filename')
-        or not hasattr(args, 'pattern')):
-        return
+    _filename = None
+    _fd = None
+    _count = 0
+    _lastCount = 0
+    _lastTime = 0.0
+    # bytes up to the end of the last intact line found by replay()
+    _intact = None
 
-    directory, pattern, filename = args.directory, args.pattern, args.filename
-    msg = "Creating DB from files in '{0}' with pattern '{1}'. Saving to '{2}'.".\
-        format(directory, pattern.pattern, filename)
-    print msg, "continue ? [Yn]"
-    answer = sys.stdin.readline()
-    if len(answer) > 1:
-        return 1
+    @staticmethod
+    def filenameFor(dbfilename):
+        return dbfilename + u".journal"
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def __init__(s, filename):
+        s._filename = os.path.abspath(filename)
+
+    def exists(s):
+        return os.path.isfile(s.filename)
+
+    # append: to the records of an interrupted run, after those replay()
+    # found intact, so a torn last line does not damage the first new one
+    def open(s, startTime, append = False):
+        s._fd = open(s.filename, append and 'a' or 'w')
+        if append and s._intact is not None:
+            s._fd.truncate(s._intact)
+        s._count, s._lastCount, s._lastTime = 0, 0, time.time()
+        if not append:
+            s._write([s.START, startTime])
+            s.checkpoint()
+
+    def _write(s, fields):
+        payload = json.dumps(fields)
+        s._fd.write("{0:08x}\t{1}\n".format(zlib.crc32(payload) & 0xffffffff,
+                                             payload))
+
+    def record(s, kind, filename, entry):
+        checksum, timestamp, cftype, fingerprint = entry
+        s._write([kind, filename, checksum, timestamp, cftypeName(cftype),
+                  fingerprint])
+        s._count += 1
+        if (s._count - s._lastCount >= s.checkpointRecords
+            or time.time() - s._lastTime >= s.checkpointSeconds):
+            s.checkpoint()
+
+    def checkpoint(s):
+        s._write([s.CHECKPOINT, s._count])
+        s._fd.flush()
+        os.fsync(s._fd.fileno())
+        s._lastCount, s._lastTime = s._count, time.time()
+
+    def close(s):
+        if s._fd is None:
+            return
+        s.checkpoint()
+        s._fd.close()
+        s._fd = None
+
+    def remove(s):
+        s.close()
+        if s.exists():
+            os.remove(s.filename)
+
+    # returns the start time of the recorded run and its records
+    # up to the first damaged line
+    def replay(s):
+        startTime, records = None, []
+        s._intact = 0
+        with open(s.filename, 'r') as fd:
+            for line in fd:
+                crc, sep, payload = line.rstrip('\n').partition('\t')
+                try:
+                    if (not line.endswith('\n') or
+                        int(crc, 16) != zlib.crc32(payload) & 0xffffffff):
+                        raise ValueError(crc)
+                    fields = json.loads(payload)
+                except ValueError:
+                    logging.warning(u"Journal '{0}' is damaged after {1} "
+                                    u"records.".format(s.filename, len(records)))
+                    break
+                s._intact += len(line)
+                if fields[0] == s.START:
+                    startTime = fields[1]
+                elif fields[0] != s.CHECKPOINT:
+                    (kind, filename, checksum, timestamp, typename,
+                     fingerprint) = fields
+                    records.append((kind, filename,
+                                    WatchEntry(checksum, timestamp,
+                                               cftypeByName(typename),
+                                               fingerprint and
+                                               tuple(fingerprint))))
+        return startTime, records
+
+ChunkManifest = collections.namedtuple('ChunkManifest',
+                                       'checksum size chunkSize digests '
+                                       'verified')
+
+class ChunkManifests(object):
+    """
+    Chunk manifests of the large files of a DB, see ChunkHasher, in an SQLite
+    file next to it. Each manifest is stored with the checksum of the
+    watchlist entry it was computed along with, and the SHA1 of its digests
+    (the root), a manifest not matching its root is ignored. For a file
+    being verified chunk by chunk, how far the verification got is kept
+    along, so an interrupted run continues from there.
+
+    >>> filename = uniqueTemporaryFilename()+".chunks"
+    >>> manifests = ChunkManifests(filename)
+    >>> manifests.put(u'bla.bin', 'c0ffee', 10, 4,
+    ...               ChunkHasher('a' * 10, 4).digest())
+    >>> manifests.progress(u'bla.bin', 2, 5.0)
+    >>> manifests.close()
+    >>> manifests = ChunkManifests(filename)
+    >>> manifest = manifests.get(u'bla.bin')
+    >>> manifest.checksum, manifest.size, manifest.chunkSize
+    (u'c0ffee', 10, 4)
+    >>> len(manifest.digests) // ChunkHasher.digestSize
+    3
+    >>> manifest.verified
+    (2, 5.0)
+    >>> manifests.remove(u'bla.bin')
+    >>> manifests.paths()
+    []
+    >>> manifests.close()
+    >>> os.remove(filename)
+    """
+    # files of at least this size get a manifest
+    minSize = 64 * 2**20
+    # commit after this many manifests stored
+    commitCount = 100
+
+    _conn = None
+    _pending = 0
+
+    @staticmethod
+    def filenameFor(dbfilename):
+        return dbfilename + u".chunks"
+
+    def __init__(s, filename):
+        s._conn = sqlite3.connect(filename)
+        s._conn.execute("PRAGMA synchronous = NORMAL")
+        s._conn.execute("CREATE TABLE IF NOT EXISTS manifest "
+                        "(path TEXT PRIMARY KEY, checksum TEXT NOT NULL, "
+                        "size INTEGER NOT NULL, "
+                        "chunksize INTEGER NOT NULL, root BLOB NOT NULL, "
+                        "digests BLOB NOT NULL, verified INTEGER, "
+                        "verifiedtime REAL)")
+
+    # ChunkManifest of a file, None if there is none or it is damaged;
+    # verified: (chunks verified, time) of an interrupted verification
+    def get(s, path):
+        row = s._conn.execute("SELECT checksum, size, chunksize, root, "
+                              "digests, "
+                              "verified, verifiedtime FROM manifest "
+                              "WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        checksum, size, chunkSize, root, digests, verified, verifiedTime = row
+        digests = str(digests)
+        if hashlib.sha1(digests).digest() != str(root):
+            logging.warning(u"Chunk manifest of '{0}' is damaged, ignored."
+                            .format(path))
+            return None
+        return ChunkManifest(checksum, size, chunkSize, digests,
+                             verified and (verified, verifiedTime))
+
+    def put(s, path, checksum, size, chunkSize, digests):
+        s._conn.execute("INSERT OR REPLACE INTO manifest VALUES "
+                        "(?, ?, ?, ?, ?, ?, NULL, NULL)",
+                        (path, checksum, size, chunkSize,
+                         buffer(hashlib.sha1(digests).digest()),
+                         buffer(digests)))
+        s._pending += 1
+        if s._pending >= s.commitCount:
+            s.commit()
+
+    def remove(s, path):
+        s._conn.execute("DELETE FROM manifest WHERE path = ?", (path,))
+
+    def paths(s):
+        return [row[0] for row in s._conn.execute("SELECT path FROM manifest")]
+
+    # record that the first 'verified' chunks of a file matched in the run
+    # started at 'time', None when done
+    def progress(s, path, verified, time = None):
+        s._conn.execute("UPDATE manifest SET verified = ?, verifiedtime = ? "
+                        "WHERE path = ?", (verified, time, path))
+        s.commit()
+
+    def commit(s):
+        s._conn.commit()
+        s._pending = 0
+
+    def close(s):
+        if s._conn is None:
+            return
+        s.commit()
+        s._conn.close()
+        s._conn = None
+
+class SampleDigests(object):
+    """
+    Digests of the sampled blocks of files, see sampleDigest(), in an SQLite
+    file next to a DB; for the sample verification level. Each is stored
+    with the checksum of the watchlist entry it was computed along with.
+
+    >>> filename = uniqueTemporaryFilename()+".samples"
+    >>> samples = SampleDigests(filename)
+    >>> samples.put(u'bla.bin', 'c0ffee', 10, 'x' * 20)
+    >>> samples.close()
+    >>> SampleDigests(filename).get(u'bla.bin', 'c0ffee', 10) == 'x' * 20
+    True
+    >>> SampleDigests(filename).get(u'bla.bin', 'decade', 10) is None
+    True
+    >>> os.remove(filename)
+    """
+    # size of the blocks and the share of them sampled
+    blockSize = 64 * 2**10
+    fraction = 0.01
+    # commit after this many digests stored
+    commitCount = 1000
+
+    _conn = None
+    _pending = 0
+
+    @staticmethod
+    def filenameFor(dbfilename):
+        return dbfilename + u".samples"
+
+    def __init__(s, filename):
+        s._conn = sqlite3.connect(filename)
+        s._conn.execute("PRAGMA synchronous = NORMAL")
+        s._conn.execute("CREATE TABLE IF NOT EXISTS sample "
+                        "(path TEXT PRIMARY KEY, checksum TEXT NOT NULL, "
+                        "size INTEGER NOT NULL, blocksize INTEGER NOT NULL, "
+                        "fraction REAL NOT NULL, digest BLOB NOT NULL)")
+
+    # the sample digest of a file with the given entry checksum and size,
+    # None if there is none, or it was sampled differently
+    def get(s, path, checksum, size):
+        row = s._conn.execute("SELECT checksum, size, blocksize, fraction, "
+                              "digest FROM sample WHERE path = ?",
+                              (path,)).fetchone()
+        if row is None or row[:4] != (checksum, size, s.blockSize,
+                                      s.fraction):
+            return None
+        return str(row[4])
+
+    def put(s, path, checksum, size, digest):
+        s._conn.execute("INSERT OR REPLACE INTO sample VALUES "
+                        "(?, ?, ?, ?, ?, ?)",
+                        (path, checksum, size, s.blockSize, s.fraction,
+                         buffer(digest)))
+        s._pending += 1
+        if s._pending >= s.commitCount:
+            s.commit()
+
+    def commit(s):
+        s._conn.commit()
+        s._pending = 0
+
+    def close(s):
+        if s._conn is None:
+            return
+        s.commit()
+        s._conn.close()
+        s._conn = None
+
+class DirListings(object):
+    """
+    Listings of the directories of a tree from its last walk, see DirCache,
+    in an SQLite file next to its DB; read one directory at a time as the
+    walk reaches it. The listings of a walk go into a new generation, which
+    replaces the last one by replace() once the DB of the walk is stored.
+
+    >>> filename = uniqueTemporaryFilename()+".dirs"
+    >>> listings = DirListings(filename)
+    >>> listings.put(u'a', (5, (u'x', u'y'), ()))
+    >>> listings.get(u'a') is None
+    True
+    >>> listings.replace()
+    >>> listings.close()
+    >>> DirListings(filename).get(u'a')
+    (5, (u'x', u'y'), ())
+    >>> os.remove(filename)
+    """
+    # commit after this many listings stored
+    commitCount = 1000
+
+    _conn = None
+    _pending = 0
+
+    @staticmethod
+    def filenameFor(dbfilename):
+        return dbfilename + u".dirs"
+
+    def __init__(s, filename):
+        s._conn = sqlite3.connect(filename)
+        s._conn.execute("PRAGMA synchronous = NORMAL")
+        for table in ("listing", "next"):
+            s._conn.execute("CREATE TABLE IF NOT EXISTS " + table +
+                            " (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, "
+                            "files BLOB NOT NULL, subdirs BLOB NOT NULL)")
+        s._conn.execute("DELETE FROM next") # of an interrupted walk
+        s._conn.commit()
+
+    # names are stored UTF-8 encoded and separated by NUL, names not
+    # decodable as the file system encoding stay byte strings
+    @staticmethod
+    def _pack(names):
+        return buffer('\0'.join(isinstance(name, unicode)
+                                 and name.encode('utf-8') or name
+                                 for name in names))
+
+    @staticmethod
+    def _unpack(blob):
+        names = []
+        for name in str(blob).split('\0') if blob else ():
+            try:
+                names.append(name.decode('utf-8'))
+            except UnicodeDecodeError:
+                names.append(name)
+        return tuple(names)
+
+    # (mtime_ns, file names, subdirectory names) of a directory in the last
+    # walk, None if it was not kept
+    def get(s, path):
+        row = s._conn.execute("SELECT mtime, files, subdirs FROM listing "
+                              "WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return row[0], s._unpack(row[1]), s._unpack(row[2])
+
+    # keep the listing of a directory in the current walk
+    def put(s, path, listing):
+        mtime, files, subdirs = listing
+        s._conn.execute("INSERT OR REPLACE INTO next VALUES (?, ?, ?, ?)",
+                        (path, mtime, s._pack(files), s._pack(subdirs)))
+        s._pending += 1
+        if s._pending >= s.commitCount:
+            s.commit()
+
+    # the listings of the current walk become those of the last one
+    def replace(s):
+        s._conn.execute("DELETE FROM listing")
+        s._conn.execute("INSERT INTO listing SELECT * FROM next")
+        s._conn.execute("DELETE FROM next")
+        s.commit()
+
+    def commit(s):
+        s._conn.commit()
+        s._pending = 0
+
+    def close(s):
+        if s._conn is None:
+            return
+        s.commit()
+        s._conn.close()
+        s._conn = None
+
+class CompactWatchlist(object):
+    """
+    Memory saving replacement for a watchlist dict. Digests are kept as raw
+    bytes in one buffer per digest size, timestamps as integers and the
+    checksum type as a small code, all in contiguous arrays indexed by slot,
+    as are the fields of the stat fingerprint. Paths are stored UTF-8
+    encoded, grouped by their interned directory. Entries are handed out as
+    the usual WatchEntry tuples.
+
+    >>> wl = CompactWatchlist()
+    >>> wl[u'a/bla.txt'] = WatchEntry('40c6f45b5673a3cc023eb175ea9e8c4e496c3217',
+    ...                               1.5, cfv.SHA1, (5, 10**18, 10**18, 42))
+    >>> wl[u'a/blub.bin'] = WatchEntry('d41d8cd98f00b204e9800998ecf8427e',
+    ...                                2.0, cfv.MD5, None)
+    >>> checksum, timestamp, cftype, fingerprint = wl[u'a/bla.txt']
+    >>> checksum, timestamp, cftype.__name__, fingerprint == (5, 10**18, 10**18, 42)
+    ('40c6f45b5673a3cc023eb175ea9e8c4e496c3217', 1.0, 'SHA1', True)
+    >>> wl[u'a/blub.bin'].fingerprint is None
+    True
+    >>> del wl[u'a/bla.txt']
+    >>> len(wl), u'a/bla.txt' in wl, sorted(wl)
+    (1, False, [u'a/blub.bin'])
+
+    The digest space given up by an entry is reused:
+
+    >>> for checksum, cftype in [('00' * 20, cfv.SHA1), ('00' * 16, cfv.MD5)] * 3:
+    ...     wl[u'a/blub.bin'] = WatchEntry(checksum, 3.0, cftype, None)
+    >>> sorted((size, len(digests)) for size, digests in wl._digests.items())
+    [(16, 16), (20, 20)]
+    """
+    def __init__(s, items = ()):
+        s._dirs = dict()       # dirname -> {basename: slot}
+        s._types = []          # type code -> (cfv type name, digest size)
+        s._typeCodes = dict()  # (cfv type name, digest size) -> type code
+        s._digests = dict()    # digest size -> bytearray of digests
+        s._freeDigests = dict() # digest size -> unused digest positions
+        s._digestPos = array.array('l')
+        s._typeCode = array.array('B')
+        s._time = array.array('l')
+        s._size = array.array('l') # -1 if the fingerprint is unknown
+        s._mtime = array.array('l')
+        s._ctime = array.array('l')
+        s._inode = array.array('L')
+        s._free = []           # slots of deleted entries
+        s._count = 0
+        for path, entry in items:
+            s[path] = entry
+
+    def __setstate__(s, state):
+        s.__dict__.update(state)
+        if '_size' not in state: # pickled without fingerprints
+            slots = len(s._time)
+            s._size = array.array('l', [-1]) * slots
+            s._mtime = array.array('l', [0]) * slots
+            s._ctime = array.array('l', [0]) * slots
+            s._inode = array.array('L', [0]) * slots
+        if '_freeDigests' not in state: # pickled without reusing digests
+            s._freeDigests = dict()
+
+    @staticmethod
+    def _split(path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        dirname, basename = os.path.split(path)
+        return intern(dirname), basename
+
+    @staticmethod
+    def _join(dirname, basename):
+        path = os.path.join(dirname, basename)
+        try:
+            return path.decode('utf-8')
+        except UnicodeDecodeError: # not decodable on the file system either
+            return path
+
+    def _slot(s, path):
+        dirname, basename = s._split(path)
+        names = s._dirs.get(dirname)
+        if names is None:
+            return None
+        return names.get(basename)
+
+    def _code(s, typename, size):
+        key = (typename, size)
+        code = s._typeCodes.get(key)
+        if code is None:
+            code = len(s._types)
+            s._types.append(key)
+            s._typeCodes[key] = code
+        return code
+
+    def _entry(s, slot):
+        typename, size = s._types[s._typeCode[slot]]
+        pos = s._digestPos[slot] * size
+        digest = s._digests[size][pos:pos+size]
+        fingerprint = None
+        if s._size[slot] >= 0:
+            fingerprint = (s._size[slot], s._mtime[slot], s._ctime[slot],
+                           s._inode[slot])
+        return WatchEntry(binascii.b2a_hex(digest), float(s._time[slot]),
+                          cftypeByName(typename), fingerprint)
+
+    def get(s, path, default = None):
+        slot = s._slot(path)
+        if slot is None:
+            return default
+        return s._entry(slot)
+
+    def __getitem__(s, path):
+        slot = s._slot(path)
+        if slot is None:
+            raise KeyError(path)
+        return s._entry(slot)
+
+    def __contains__(s, path):
+        return s._slot(path) is not None
+
+    def __setitem__(s, path, entry):
+        checksum, timestamp, cftype, fingerprint = entry
+        digest = bytes(binascii.a2b_hex(checksum))
+        size = len(digest)
+        dirname, basename = s._split(path)
+        names = s._dirs.setdefault(dirname, dict())
+        slot = names.get(basename)
+        if slot is None:
+            if s._free:
+                slot = s._free.pop()
+            else:
+                slot = len(s._time)
+                s._digestPos.append(-1)
+                s._typeCode.append(0)
+                for values in (s._time, s._size, s._mtime, s._ctime, s._inode):
+                    values.append(0)
+            names[basename] = slot
+            s._count += 1
+        digests = s._digests.setdefault(size, bytearray())
+        pos = s._digestPos[slot]
+        if pos >= 0 and s._types[s._typeCode[slot]][1] != size:
+            s._freeDigest(slot)
+            pos = -1
+        if pos < 0:
+            # no digest of that size in this slot yet, reuse a free one
+            free = s._freeDigests.get(size)
+            if free:
+                pos = free.pop()
+            else:
+                pos = len(digests) // size
+                digests.extend(digest)
+        digests[pos*size:(pos+1)*size] = digest
+        s._digestPos[slot] = pos
+        s._typeCode[slot] = s._code(cftypeName(cftype), size)
+        s._time[slot] = int(timestamp)
+        if fingerprint is None:
+            s._size[slot] = -1
+        else:
+            (s._size[slot], s._mtime[slot], s._ctime[slot],
+             s._inode[slot]) = fingerprint
+
+    # gives the digest of a slot up for reuse by digests of the same size
+    def _freeDigest(s, slot):
+        size = s._types[s._typeCode[slot]][1]
+        s._freeDigests.setdefault(size, []).append(s._digestPos[slot])
+        s._digestPos[slot] = -1
+
+    def __delitem__(s, path):
+        dirname, basename = s._split(path)
+        names = s._dirs.get(dirname)
+        if names is None or basename not in names:
+            raise KeyError(path)
+        slot = names.pop(basename)
+        s._freeDigest(slot)
+        s._free.append(slot)
+        if not names:
+            del s._dirs[dirname]
+        s._count -= 1
+
+    def __len__(s):
+        return s._count
+
+    def iteritems(s):
+        for dirname, names in s._dirs.iteritems():
+            for basename, slot in names.iteritems():
+                yield s._join(dirname, basename), s._entry(slot)
+
+    def __iter__(s):
+        for dirname, names in s._dirs.iteritems():
+            for basename in names:
+                yield s._join(dirname, basename)
+
+## storage formats ##
+
+# ChecksumDB attributes kept in the meta data of a DB file
+_dbMeta = ('_directory', '_rules', '_checkInterval', '_count',
+           '_scanTime', '_defaultType')
+
+# paths are ordered by their UTF-8 encoding in sorted DB formats
+def pathKey(path):
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+# merge the changes kept for a DB file into its items sorted by path,
+# changes of deleted entries are None
+def _mergeChanges(items, changed):
+    pending = sorted(changed.iteritems(),
+                     key = lambda item: pathKey(item[0]), reverse = True)
+    for path, entry in items:
+        key = pathKey(path)
+        while pending and pathKey(pending[-1][0]) <= key:
+            changedPath, changedEntry = pending.pop()
+            if changedEntry is not None:
+                yield changedPath, changedEntry
+            if pathKey(changedPath) == key:
+                break
+        else:
+            yield path, entry
+    while pending:
+        changedPath, changedEntry = pending.pop()
+        if changedEntry is not None:
+            yield changedPath, changedEntry
+
+# iterate (path, entry) items of any watchlist sorted by path
+def sortedItems(watchlist):
+    if hasattr(watchlist, 'itersorted'):
+        return watchlist.itersorted()
+    return ((path, watchlist[path])
+            for path in sorted(watchlist, key = pathKey))
+
+_sqliteFingerprint = ('size', 'mtime_ns', 'ctime_ns', 'inode')
+_sqliteColumns = "checksum, time, type, " + ", ".join(_sqliteFingerprint)
+
+def _sqliteRow(path, entry):
+    fingerprint = entry.fingerprint or (None,) * len(_sqliteFingerprint)
+    return (path, entry.checksum, entry.time, cftypeName(entry.type)) \
+           + tuple(fingerprint)
+
+def _sqliteConnect(filename):
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                 "(key TEXT PRIMARY KEY, value BLOB)")
+    conn.execute("CREATE TABLE IF NOT EXISTS watchlist "
+                 "(path TEXT PRIMARY KEY, checksum TEXT NOT NULL, "
+                 "time REAL NOT NULL, type TEXT NOT NULL) WITHOUT ROWID")
+    conn.execute("CREATE INDEX IF NOT EXISTS watchlist_time "
+                 "ON watchlist (time)")
+    # stat fingerprint, NULL if unknown
+    columns = set(row[1] for row in
+                  conn.execute("PRAGMA table_info(watchlist)"))
+    for column in _sqliteFingerprint:
+        if column not in columns:
+            conn.execute("ALTER TABLE watchlist ADD COLUMN {0} INTEGER"
+                         .format(column))
+    return conn
+
+class SQLiteWatchlist(object):
+    """
+    Dict-like view on the watchlist table of a SQLite checksum DB.
+    Rows are read on demand, changes are kept until flush() writes them.
+
+    >>> wl = SQLiteWatchlist(_sqliteConnect(":memory:"))
+    >>> wl[u'bla.txt'] = WatchEntry('40c6f45b5673a3cc023eb175ea9e8c4e496c3217',
+    ...                             1.0, cfv.SHA1, (5, 10**18, 10**18, 42))
+    >>> u'bla.txt' in wl, len(wl)
+    (True, 1)
+    >>> wl.flush()
+    >>> wl[u'bla.txt'].type.__name__, wl[u'bla.txt'].fingerprint
+    ('SHA1', (5, 1000000000000000000, 1000000000000000000, 42))
+    >>> del wl[u'bla.txt']
+    >>> wl.flush()
+    >>> len(wl), wl.get(u'bla.txt')
+    (0, None)
+    """
+    _conn = None
+    _filename = None
+    _changed = None # path -> entry, None for deleted entries
+    _count = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def __init__(s, conn, filename = None):
+        s._conn = conn
+        s._filename = filename
+        s._changed = dict()
+        s._count = conn.execute("SELECT count(*) FROM watchlist").fetchone()[0]
+
+    @staticmethod
+    def _toEntry(row):
+        checksum, time, typename = row[:3]
+        fingerprint = row[3:]
+        if fingerprint[0] is None:
+            fingerprint = None
+        return WatchEntry(checksum, time, cftypeByName(typename), fingerprint)
+
+    def _select(s, path):
+        row = s._conn.execute("SELECT " + _sqliteColumns + " FROM watchlist "
+                              "WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return s._toEntry(row)
+
+    def get(s, path, default = None):
+        if path in s._changed:
+            entry = s._changed[path]
+        else:
+            entry = s._select(path)
+        if entry is None:
+            return default
+        return entry
+
+    def __getitem__(s, path):
+        entry = s.get(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry
+
+    def __contains__(s, path):
+        return s.get(path) is not None
+
+    def __setitem__(s, path, entry):
+        if path not in s:
+            s._count += 1
+        s._changed[path] = entry
+
+    def __delitem__(s, path):
+        if path not in s:
+            raise KeyError(path)
+        s._count -= 1
+        s._changed[path] = None
+
+    def __len__(s):
+        return s._count
+
+    def iteritems(s):
+        cursor = s._conn.execute("SELECT path, " + _sqliteColumns +
+                                 " FROM watchlist")
+        for row in cursor:
+            if row[0] in s._changed:
+                continue
+            yield row[0], s._toEntry(row[1:])
+        for path, entry in s._changed.items():
+            if entry is not None:
+                yield path, entry
+
+    def __iter__(s):
+        for path, entry in s.iteritems():
+            yield path
+
+    # (path, size) of the stored entries, verified longest ago first
+    def iteroldest(s):
+        return iter(s._conn.execute("SELECT path, coalesce(size, 0) "
+                                    "FROM watchlist ORDER BY time, path"))
+
+    def totalBytes(s):
+        return s._conn.execute("SELECT total(size) FROM watchlist").fetchone()[0]
+
+    def itersorted(s):
+        cursor = s._conn.execute("SELECT path, " + _sqliteColumns +
+                                 " FROM watchlist ORDER BY path")
+        return _mergeChanges(((row[0], s._toEntry(row[1:])) for row in cursor),
+                             s._changed)
+
+    def flush(s):
+        # upsert the touched rows only
+        changed = s._changed.items()
+        s._conn.executemany("DELETE FROM watchlist WHERE path = ?",
+                            ((path,) for path, entry in changed
+                                      if entry is None))
+        s._conn.executemany("INSERT OR REPLACE INTO watchlist "
+                            "(path, " + _sqliteColumns + ") "
+                            "VALUES (?,?,?,?,?,?,?,?)",
+                            (_sqliteRow(path, entry)
+                             for path, entry in changed if entry is not None))
+        s._conn.commit()
+        s._changed.clear()
+
+def _storeSQLiteMeta(db, conn):
+    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)",
+                     ((key, sqlite3.Binary(pickle.dumps(getattr(db, key), 2)))
+                      for key in _dbMeta))
+
+def _storeSQLite(db, outfile):
+    watchlist = db.watchlist
+    if (isinstance(watchlist, SQLiteWatchlist)
+        and watchlist.filename == outfile):
+        # DB was loaded from this file, write the changes only
+        _storeSQLiteMeta(db, watchlist._conn)
+        watchlist.flush()
+        return
+    # write a complete new DB, e.g. when importing a pickled one
+    tmpfile = outfile + u".tmp"
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    conn = _sqliteConnect(tmpfile)
+    try:
+        conn.executemany("INSERT INTO watchlist (path, " + _sqliteColumns +
+                         ") VALUES (?,?,?,?,?,?,?,?)",
+                         (_sqliteRow(path, entry)
+                          for path, entry in watchlist.iteritems()))
+        _storeSQLiteMeta(db, conn)
+        conn.commit()
+    finally:
+        conn.close()
+    os.rename(tmpfile, outfile)
+    db._watchlist = SQLiteWatchlist(_sqliteConnect(outfile), outfile)
+
+def _loadSQLite(filename):
+    conn = _sqliteConnect(filename)
+    db = ChecksumDB.__new__(ChecksumDB)
+    for key, value in conn.execute("SELECT key, value FROM meta"):
+        if key in _dbMeta:
+            setattr(db, key, pickle.loads(str(value)))
+    db._watchlist = SQLiteWatchlist(conn, filename)
+    return db
+
+class MappedWatchlist(object):
+    """
+    Watchlist on a sorted binary DB file which is mapped into memory instead
+    of being loaded. The file consists of a header, fixed size records sorted
+    by path, a table of digests and UTF-8 encoded paths the records point to
+    and the pickled meta data of the DB. Lookups are binary searches over
+    the records. Changes are kept in memory until the DB is stored again.
+
+    >>> import shutil, tempfile
+    >>> testdir = tempfile.mkdtemp()
+    >>> dbfile = os.path.join(testdir, "checksum.db")
+    >>> db = ChecksumDB(testdir)
+    >>> db.watchlist[u'bla.txt'] = WatchEntry('40c6f45b5673a3cc023eb175ea9e8c4e496c3217',
+    ...                                       1.0, cfv.SHA1, None)
+    >>> db.store(dbfile, "mapped")
+    >>> db = ChecksumDB.load(dbfile)
+    >>> db.format, db.watchlist[u'bla.txt'][0], u'blub.bin' in db.watchlist
+    ('mapped', '40c6f45b5673a3cc023eb175ea9e8c4e496c3217', False)
+    >>> shutil.rmtree(testdir)
+    """
+    magic = "DVDBMAP\x00"
+    version = 2
+    # magic, version, record size, record count,
+    # offset of the string table, offset and length of the meta data
+    header = struct.Struct('<8sIIQQQQ')
+    # offset of digest+path in the string table, path length,
+    # digest length, type code, time,
+    # fingerprint size (-1 if unknown), mtime_ns, ctime_ns, inode
+    record = struct.Struct('<QHBBqqqqQ')
+
+    _filename = None
+    _map = None
+    _size = 0
+    _types = None
+    _changed = None
+    _count = None
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def __init__(s, filename):
+        s._filename = filename
+        with open(filename, 'rb') as fd:
+            s._map = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, version, recordSize, count, stringsOffset,
+         metaOffset, metaLength) = s.header.unpack_from(s._map, 0)
+        if (magic != s.magic or version != s.version
+            or recordSize != s.record.size):
+            raise MyError(u"Unsupported database file '{0}'!".format(filename))
+        s.meta = pickle.loads(s._map[metaOffset:metaOffset+metaLength])
+        s._types = [cftypeByName(name) for name in s.meta['types']]
+        s._size = s._count = count
+        s._changed = dict()
+
+    def _record(s, index):
+        return s.record.unpack_from(s._map, s.header.size + index*s.record.size)
+
+    def _key(s, index):
+        offset, pathLength, digestLength = s._record(index)[:3]
+        offset += digestLength
+        return s._map[offset:offset+pathLength]
+
+    def _find(s, path):
+        key = pathKey(path)
+        lo, hi = 0, s._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if s._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < s._size and s._key(lo) == key:
+            return lo
+        return None
+
+    def _entry(s, index):
+        record = s._record(index)
+        offset, pathLength, digestLength, code, timestamp = record[:5]
+        digest = s._map[offset:offset+digestLength]
+        fingerprint = record[5:]
+        if fingerprint[0] < 0:
+            fingerprint = None
+        return WatchEntry(binascii.b2a_hex(digest), float(timestamp),
+                          s._types[code], fingerprint)
+
+    def get(s, path, default = None):
+        if path in s._changed:
+            entry = s._changed[path]
+        else:
+            index = s._find(path)
+            entry = index is not None and s._entry(index) or None
+        if entry is None:
+            return default
+        return entry
+
+    def __getitem__(s, path):
+        entry = s.get(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry
+
+    def __contains__(s, path):
+        return s.get(path) is not None
+
+    def __setitem__(s, path, entry):
+        if path not in s:
+            s._count += 1
+        s._changed[path] = entry
+
+    def __delitem__(s, path):
+        if path not in s:
+            raise KeyError(path)
+        s._count -= 1
+        s._changed[path] = None
+
+    def __len__(s):
+        return s._count
 
-    db = ChecksumDB(directory, pattern)
-    db.store(filename)
+    def _iterRecords(s):
+        for index in xrange(s._size):
+            path = s._key(index)
+            try:
+                path = path.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            yield path, s._entry(index)
+
+    def itersorted(s):
+        return _mergeChanges(s._iterRecords(), s._changed)
+
+    iteritems = itersorted
+
+    def __iter__(s):
+        for path, entry in s.itersorted():
+            yield path
+
+def _storeMapped(db, outfile):
+    count = len(db.watchlist)
+    header, record = MappedWatchlist.header, MappedWatchlist.record
+    types, typeCodes = [], dict()
+    stringsOffset = header.size + count * record.size
+    offset, written = stringsOffset, 0
+    tmpfile = outfile + u".tmp"
+    # records and string table are written through separate handles
+    with open(tmpfile, 'wb') as fd:
+        fd.seek(header.size)
+        with open(tmpfile, 'r+b') as strings:
+            strings.seek(stringsOffset)
+            for path, entry in sortedItems(db.watchlist):
+                checksum, timestamp, cftype, fingerprint = entry
+                if cftype not in typeCodes:
+                    typeCodes[cftype] = len(types)
+                    types.append(cftypeName(cftype))
+                digest, path = binascii.a2b_hex(checksum), pathKey(path)
+                fd.write(record.pack(offset, len(path), len(digest),
+                                     typeCodes[cftype], int(timestamp),
+                                     *(fingerprint or (-1, 0, 0, 0))))
+                strings.write(digest)
+                strings.write(path)
+                offset += len(digest) + len(path)
+                written += 1
+        if written != count:
+            raise MyError(u"Watchlist changed while storing it!")
+        meta = dict((key, getattr(db, key)) for key in _dbMeta)
+        meta['types'] = types
+        meta = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+        fd.seek(offset)
+        fd.write(meta)
+        fd.seek(0)
+        fd.write(header.pack(MappedWatchlist.magic, MappedWatchlist.version,
+                             record.size, count, stringsOffset,
+                             offset, len(meta)))
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(tmpfile, outfile)
+    db._watchlist = MappedWatchlist(outfile)
+
+def _loadMapped(filename):
+    watchlist = MappedWatchlist(filename)
+    db = ChecksumDB.__new__(ChecksumDB)
+    for key in _dbMeta:
+        if key in watchlist.meta:
+            setattr(db, key, watchlist.meta[key])
+    db._watchlist = watchlist
+    return db
+
+def _storePickle(db, outfile):
+    with open(outfile, 'wb') as fd:
+        pickle.dump(db, fd, pickle.HIGHEST_PROTOCOL)
+
+def _loadPickle(filename):
+    """
+    DBs pickled by older versions keep a dict of (checksum, time, type)
+    tuples, without fingerprints:
+
+    >>> legacy = ChecksumDB(u".")
+    >>> state = dict(legacy.__dict__, _count = 1, _watchlist = {u'bla.txt':
+    ...     ('40c6f45b5673a3cc023eb175ea9e8c4e496c3217', 1.0, cfv.SHA1)})
+    >>> legacy.__getstate__ = lambda: state
+    >>> filename = uniqueTemporaryFilename() + ".db"
+    >>> with open(filename, 'wb') as fd: pickle.dump(legacy, fd)
+    >>> db = _loadPickle(filename)
+    >>> entry = db.watchlist[u'bla.txt']
+    >>> entry.checksum, entry.time, entry.type.__name__, entry.fingerprint
+    ('40c6f45b5673a3cc023eb175ea9e8c4e496c3217', 1.0, 'SHA1', None)
+    >>> os.remove(filename)
+    """
+    with open(filename, 'rb') as fd:
+        db = pickle.load(fd)
+    if isinstance(db._watchlist, dict): # pickled by an older version
+        db._watchlist = CompactWatchlist(
+            (path, WatchEntry(*(tuple(entry) + (None,) * (4 - len(entry)))))
+            for path, entry in db._watchlist.iteritems())
+    return db
+
+# format name -> (load function, store function)
+dbFormats = {
+    "pickle": (_loadPickle, _storePickle),
+    "sqlite": (_loadSQLite, _storeSQLite),
+    "mapped": (_loadMapped, _storeMapped),
+}
+
+def detectFormat(filename):
+    with open(filename, 'rb') as fd:
+        header = fd.read(16)
+    if header == "SQLite format 3\x00":
+        return "sqlite"
+    if header.startswith(MappedWatchlist.magic):
+        return "mapped"
+    return "pickle"
+
+## change tracking ##
+
+class Inotify(object):
+    """
+    Minimal binding of the Linux inotify API. read() returns the pending
+    events as (watch descriptor, mask, cookie, name) tuples.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    event = struct.Struct('iIII')
+
+    _fd = None
+
+    def __init__(s):
+        if _libc is None:
+            raise MyError(u"inotify is not available on this system!")
+        s._fd = _libc.inotify_init()
+        if s._fd < 0:
+            s._error()
+
+    @staticmethod
+    def _error(path = None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def fileno(s):
+        return s._fd
+
+    def addWatch(s, path, mask):
+        wd = _libc.inotify_add_watch(s._fd,
+                path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            s._error(path)
+        return wd
+
+    def removeWatch(s, wd):
+        _libc.inotify_rm_watch(s._fd, wd) # fails for watches gone already
+
+    def read(s):
+        data, events, offset = os.read(s._fd, 2**16), [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = s.event.unpack_from(data, offset)
+            offset += s.event.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie,
+                           name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(s):
+        if s._fd is not None:
+            os.close(s._fd)
+            s._fd = None
+
+class DirtySet(object):
+    """
+    Paths changed in a watched tree, as recorded by watchTree(). The watch
+    daemon appends to the file while holding a lock on it, verify claims the
+    records by renaming the file and releases them once the DB is stored.
+    The records only replace a full walk if the daemon watches the tree
+    continuously since the DB was last brought up to date, see claim().
+
+    >>> filename = uniqueTemporaryFilename()+".dirty"
+    >>> dirty = DirtySet(filename)
+    >>> dirty.add([(DirtySet.FILE, u'a/b.txt'), (DirtySet.TREE, u'c')])
+    >>> records, complete = dirty.claim(time.time())
+    >>> records, complete, os.path.exists(filename)
+    ([(u'FILE', u'a/b.txt'), (u'TREE', u'c')], False, False)
+    >>> dirty.add([(DirtySet.OVERFLOW, None)])
+    >>> len(dirty.claim(time.time())[0]) # unreleased records are kept
+    3
+    >>> dirty.release()
+    >>> [fn for fn in dirty.filenames if os.path.exists(fn)]
+    []
+    """
+    FILE = u"FILE" # a file was changed, created or removed
+    TREE = u"TREE" # a directory was created, moved or removed
+    OVERFLOW = u"OVERFLOW" # events were lost
+
+    _filename = None
+
+    @staticmethod
+    def filenameFor(dbfilename):
+        return dbfilename + u".dirty"
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def claimedFilename(self):
+        return self._filename + u".claimed"
+
+    @property
+    def lockFilename(self):
+        return self._filename + u".lock"
+
+    @property
+    def filenames(self):
+        return (self.filename, self.claimedFilename, self.lockFilename)
+
+    def __init__(s, filename):
+        s._filename = os.path.abspath(filename)
+
+    # appends records, reopening the file if it was claimed meanwhile
+    def add(s, records):
+        while True:
+            fd = open(s.filename, 'a')
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd.fileno()).st_ino == os.stat(s.filename).st_ino:
+                    break
+            except OSError: # renamed and not recreated yet
+                pass
+            fd.close()
+        with fd:
+            for kind, path in records:
+                fd.write(json.dumps([kind, path]) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    # takes the lock held by the daemon as long as it runs
+    def lock(s):
+        fd = open(s.lockFilename, 'a+')
+        try:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fd.close()
+            raise MyError(u"Tree is watched already, see '{0}'."
+                          .format(s.lockFilename))
+        fd.truncate(0)
+        return fd
+
+    # since when the running daemon is watching the complete tree,
+    # None if it does not run
+    def watchingSince(s):
+        try:
+            fd = open(s.lockFilename, 'r')
+        except IOError:
+            return None
+        with fd:
+            try:
+                fcntl.flock(fd.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return None # not locked by a daemon
+            except IOError:
+                pass
+            try:
+                return float(fd.read())
+            except ValueError: # still setting up the watches
+                return None
+
+    # returns the records not released yet and whether they cover all
+    # changes since scanTime
+    def claim(s, scanTime):
+        since = s.watchingSince()
+        try:
+            os.rename(s.filename, s.filename + u".new")
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            with open(s.filename + u".new", 'r') as fd:
+                # wait for a daemon writing to it before the rename
+                fcntl.flock(fd.fileno(), fcntl.LOCK_SH)
+                data = fd.read()
+            with open(s.claimedFilename, 'a') as fd:
+                fd.write(data)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.remove(s.filename + u".new")
+        records = []
+        if os.path.exists(s.claimedFilename):
+            with open(s.claimedFilename, 'r') as fd:
+                for line in fd:
+                    if not line.endswith('\n'): # torn by a crash
+                        break
+                    records.append(tuple(json.loads(line)))
+        complete = (since is not None and scanTime is not None
+                    and since <= scanTime
+                    and (s.OVERFLOW, None) not in records)
+        return records, complete
+
+    def release(s):
+        if os.path.exists(s.claimedFilename):
+            os.remove(s.claimedFilename)
+
+# events of interest in a watched directory
+_watchMask = (Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE |
+              Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_CREATE |
+              Inotify.IN_DELETE | Inotify.IN_DELETE_SELF | Inotify.IN_ONLYDIR)
+
+# records the paths changed in the tree of db in dirty until interrupted,
+# written every 'interval' seconds
+def watchTree(db, dirty, interval = 1.0):
+    inotify = Inotify()
+    watches = dict() # watch descriptor -> relpath of the directory
+    def addTree(relpath):
+        pending = [relpath]
+        while pending:
+            relpath = pending.pop()
+            path = os.path.join(db.directory, relpath)
+            try:
+                wd = inotify.addWatch(path, _watchMask)
+            except OSError, e:
+                logging.warning(u"Could not watch directory '{0}': {1}"
+                                .format(path, cfv.enverrstr(e)))
+                continue
+            if wd in watches:
+                # watched already, reached again by a symlink
+                logging.warning(u"Skipping already visited directory '{0}'."
+                                .format(path))
+                continue
+            watches[wd] = relpath
+            files, subdirs = _listDir(path, relpath, rules = db.rules)
+            pending.extend(os.path.join(relpath, name) for name, st in subdirs)
+    def removeTree(relpath):
+        prefix = os.path.join(relpath, u'')
+        for wd, path in watches.items():
+            if path == relpath or path.startswith(prefix):
+                inotify.removeWatch(wd)
+                del watches[wd]
+    lockFd = dirty.lock()
+    try:
+        addTree(db.directory[:0])
+        lockFd.write(repr(time.time()))
+        lockFd.flush()
+        logging.info(u"Watching {0} directories in '{1}' ..."
+                     .format(len(watches), db.directory))
+        records, lastWrite = [], time.time()
+        while True:
+            if select.select([inotify], [], [], interval)[0]:
+                events = inotify.read()
+            else:
+                events = []
+            for wd, mask, cookie, name in events:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    logging.warning(u"Events were lost, the next verify "
+                                    u"walks the whole tree.")
+                    records.append((DirtySet.OVERFLOW, None))
+                    continue
+                if wd not in watches:
+                    continue
+                if mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF):
+                    del watches[wd]
+                    continue
+                relpath = os.path.join(watches[wd], name)
+                isDir = bool(mask & Inotify.IN_ISDIR)
+                if db.rules.excluded(relpath, isDir):
+                    continue
+                if not isDir:
+                    records.append((DirtySet.FILE, relpath))
+                    continue
+                if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    removeTree(relpath)
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    addTree(relpath)
+                records.append((DirtySet.TREE, relpath))
+            if records and time.time() - lastWrite >= interval:
+                # drop duplicates, keeping the order
+                seen = set()
+                dirty.add([record for record in records
+                           if record not in seen and not seen.add(record)])
+                records, lastWrite = [], time.time()
+    finally:
+        inotify.close()
+        lockFd.close()
+
+## throttling ##
+
+class TokenBucket(object):
+    """
+    Admits 'rate' units per second on average and bursts of up to 'burst'.
+    take() debits the units and returns how long to wait to stay within the
+    rate; the bucket goes into debt, so requests larger than the burst pass.
+
+    >>> bucket = TokenBucket(10.0, 5.0, clock = lambda: 0.0)
+    >>> bucket.take(5), bucket.take(10)
+    (0.0, 1.0)
+    """
+    def __init__(s, rate, burst = None, clock = time.time):
+        s.rate = rate
+        s._burst = burst or rate
+        s._clock = clock
+        s._tokens, s._last = s._burst, clock()
+
+    # rate: to refill at instead of the configured one
+    def take(s, count, rate = None):
+        rate = rate or s.rate
+        now = s._clock()
+        s._tokens = min(s._burst, s._tokens + (now - s._last) * rate)
+        s._last = now
+        s._tokens -= count
+        return max(0.0, -s._tokens / rate)
+
+class _DeviceThrottle(object):
+    # limits and read latency of a device, see Governor
+    def __init__(s, rate, fileRate):
+        s.bytes = rate and TokenBucket(rate)
+        s.files = fileRate and TokenBucket(fileRate)
+        s.latency = s.baseline = None
+        s.factor, s.adjusted = 1.0, 0.0
+
+class Governor(object):
+    """
+    Limits the reads for checksumming per device to a number of bytes and
+    files per second, see TokenBucket. If backoff is set, the reads slow
+    down further while their latency rises above the lowest the device
+    showed, and speed up again as it recovers; without a byte limit by
+    pausing between reads. Installed as cfv.throttle, thread-safe.
+
+    >>> governor = Governor({1: 100 * 2**20}, backoff = False)
+    >>> governor.read(1, 101 * 2**20) # one MiB beyond the burst
+    >>> 0.0 < governor.waited < 0.1
+    True
+    """
+    # back off when the average time to read a MiB exceeds the lowest seen
+    # by this ratio, down to minFactor of the limit
+    backoffRatio = 2.0
+    minFactor = 1.0 / 16
+    # seconds per MiB never backed off from: cached reads or an idle device,
+    # measuring these is dominated by scheduling noise
+    minLatency = 0.005
+    # reads smaller than this do not measure latency
+    minSample = 64 * 2**10
+
+    # rates, fileRates: bytes and files per second by device,
+    #                   None for the others: the defaults, unlimited if None
+    def __init__(s, rates = None, fileRates = None, defaultRate = None,
+                 defaultFileRate = None, backoff = True):
+        s._rates, s._defaultRate = rates or dict(), defaultRate
+        s._fileRates, s._defaultFileRate = fileRates or dict(), defaultFileRate
+        s._backoff = backoff
+        s._devices = dict()
+        s._lock = threading.Lock()
+        s.waited = 0.0 # seconds slept in total
+
+    def _device(s, dev):
+        if dev not in s._devices:
+            s._devices[dev] = _DeviceThrottle(
+                s._rates.get(dev, s._defaultRate),
+                s._fileRates.get(dev, s._defaultFileRate))
+        return s._devices[dev]
+
+    def _sleep(s, seconds):
+        if seconds > 0:
+            with s._lock:
+                s.waited += seconds
+            time.sleep(seconds)
+
+    # before reading a file
+    def file(s, dev):
+        with s._lock:
+            device = s._device(dev)
+            wait = device.files and device.files.take(1) or 0.0
+        s._sleep(wait)
+
+    # after reading a block, seconds: it took, None if not measured
+    def read(s, dev, count, seconds = None):
+        with s._lock:
+            device = s._device(dev)
+            if s._backoff and seconds is not None and count >= s.minSample:
+                s._adapt(dev, device, seconds * 2**20 / count)
+            wait = 0.0
+            if device.bytes:
+                wait = device.bytes.take(count,
+                                         device.bytes.rate * device.factor)
+            elif seconds is not None and device.factor < 1.0:
+                wait = seconds * (1.0 / device.factor - 1.0)
+        s._sleep(wait)
+
+    # follow the latency per MiB of a device, the lowest seen creeps up
+    # slowly so a lasting change of the load becomes the new baseline
+    def _adapt(s, dev, device, latency):
+        if device.latency is None:
+            device.latency = latency
+        else:
+            device.latency = 0.8 * device.latency + 0.2 * latency
+        if device.baseline is None or device.latency < device.baseline:
+            device.baseline = device.latency
+        else:
+            device.baseline *= 1.001
+        now = time.time()
+        if now - device.adjusted < 1.0:
+            return
+        if (device.latency > max(s.backoffRatio * device.baseline,
+                                 s.minLatency)
+            and device.factor > s.minFactor):
+            device.factor = max(device.factor / 2, s.minFactor)
+        elif device.latency < 1.25 * device.baseline and device.factor < 1.0:
+            device.factor = min(device.factor * 1.25, 1.0)
+        else:
+            return
+        device.adjusted = now
+        logging.debug(u"Reading from device {0} at {1:.0%} of the rate, "
+                      u"{2:.1f} ms per MiB.".format(dev, device.factor,
+                                                    device.latency * 1000))
+
+# lower the priority of this process and the threads and processes it
+# starts: the idle I/O scheduling class, if idle, and CPU niceness
+# increased by nice
+_ioprioSet = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+              'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+def lowerPriority(idle = False, nice = 0):
+    if nice:
+        os.nice(nice)
+    if not idle:
+        return
+    import platform
+    syscall = _ioprioSet.get(platform.machine())
+    if _libc is None or syscall is None:
+        raise MyError(u"Setting the I/O priority is not supported on this "
+                      u"platform.")
+    # IOPRIO_WHO_PROCESS, this process, IOPRIO_CLASS_IDLE
+    if _libc.syscall(syscall, 1, 0, 3 << 13) != 0:
+        raise MyError(u"Setting the I/O priority failed: {0}"
+                      .format(os.strerror(ctypes.get_errno())))
+
+## progress ##
+
+class Progress(object):
+    """
+    Counts the files and bytes a check() is done with, from any thread. A
+    reporter thread logs them every 'interval' seconds with the rate and,
+    if the bytes expected in total are known, the time left; the hashing
+    only adds to the counters and never waits for the output. The rate is
+    measured from begin(), leaving out the walk and setup before the first
+    files are hashed.
+
+    >>> times = iter([0.0, 10.0])
+    >>> progress = Progress(60, 400 * 2**20, clock = lambda: next(times))
+    >>> progress.begin()
+    >>> progress.add(100 * 2**20)
+    >>> print progress.report()
+    Progress: 1 files, 100.0 of about 400.0 MiB (25%) at 10.0 MiB/s, 0:00:30 left.
+    """
+    # total: bytes expected, None if unknown
+    def __init__(s, interval, total = None, clock = time.time):
+        s.interval = interval
+        s.total = total
+        s._clock = clock
+        s._start = None # see begin()
+        s._lock = threading.Lock()
+        s._stop = threading.Event()
+        s._thread = None
+        s.files = s.bytes = 0
+
+    # starts the clock, when the first jobs are handed out for hashing
+    def begin(s):
+        if s._start is None:
+            s._start = s._clock()
+
+    def add(s, size):
+        with s._lock:
+            s.files += 1
+            s.bytes += size
+
+    def report(s):
+        with s._lock:
+            files, done = s.files, s.bytes
+        now = s._clock()
+        start = now if s._start is None else s._start
+        rate = done / max(now - start, 1e-3)
+        if not s.total:
+            return (u"Progress: {0} files, {1:.1f} MiB at {2:.1f} MiB/s."
+                    .format(files, done / 2.**20, rate / 2**20))
+        left = max(s.total - done, 0) / rate if rate else float('inf')
+        left = (u"{0}:{1:02}:{2:02}".format(int(left) // 3600,
+                                             int(left) // 60 % 60,
+                                             int(left) % 60)
+                if left < float('inf') else u"?")
+        return (u"Progress: {0} files, {1:.1f} of about {2:.1f} MiB ({3:.0%}) "
+                u"at {4:.1f} MiB/s, {5} left."
+                .format(files, done / 2.**20, s.total / 2.**20,
+                        min(done / float(s.total), 1.0), rate / 2**20, left))
+
+    def _run(s):
+        while not s._stop.wait(s.interval):
+            logging.info(s.report())
+
+    def start(s):
+        s._thread = threading.Thread(target = s._run)
+        s._thread.daemon = True
+        s._thread.start()
+
+    def stop(s):
+        s._stop.set()
+        if s._thread is not None:
+            s._thread.join()
+            s._thread = None
+
+## benchmarks ##
+
+# drop the cached pages of a file, so reading it hits the disk again
+def evictFile(filename):
+    if cfv.fadvise is None:
+        raise MyError("Evicting files from the page cache is not supported "
+                      "on this platform.")
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        cfv.fadvise(fd, 0, 0, cfv.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def _benchReport(label, count, size, elapsed):
+    print u"{0:<12} {1:>8} files {2:>10.1f} MiB {3:>8.2f} s {4:>8.1f} MiB/s"\
+          .format(label, count, size / 2.**20, elapsed,
+                  size / 2.**20 / max(elapsed, 1e-9))
+
+# hashing throughput of the files in a tree read in walk order vs. the
+# orders of scheduleJobs(), the time for scheduling included
+def benchOrder(args):
+    jobs = [HashJob(treeEntry.relpath, treeEntry.stat, None, (cfv.SHA1,))
+            for treeEntry in walkTree(args.directory)]
+    cfv.chdir(args.directory)
+    try:
+        for order in ("walk", "inode", "physical"):
+            for job in jobs:
+                evictFile(job.filename)
+            start, size = time.time(), 0
+            for job in scheduleJobs(jobs, order):
+                size += cfv._getfilesha1(job.filename)[1]
+            _benchReport(order, len(jobs), size, time.time() - start)
+    finally:
+        cfv.cdup()
+
+# hashing throughput of the files in a tree for each of the cfv.READMODES,
+# starting with the files evicted from the page cache; 'cached' reads them
+# again right after the default mode, as a scrub would find them cached
+def benchReadMode(args):
+    filenames = [treeEntry.relpath for treeEntry in walkTree(args.directory)]
+    cfv.chdir(args.directory)
+    runs = [("default", True), ("cached", False)]
+    runs += [(mode, True) for mode in cfv.READMODES if mode != "default"]
+    try:
+        for label, evict in runs:
+            if evict:
+                for filename in filenames:
+                    evictFile(filename)
+            cfv.readmode = label == "cached" and "default" or label
+            start, size = time.time(), 0
+            for filename in filenames:
+                size += cfv._getfilesha1(filename)[1]
+            _benchReport(label, len(filenames), size, time.time() - start)
+    finally:
+        cfv.readmode = "default"
+        cfv.cdup()
+
+# hashing throughput of each digest cfv can compute, over the files in a
+# tree read into the page cache first
+def benchDigest(args):
+    filenames = [treeEntry.relpath for treeEntry in walkTree(args.directory)]
+    cfv.chdir(args.directory)
+    try:
+        for filename in filenames: # warm up the cache
+            cfv._getfilechecksum(filename, cfv.CRC32)
+        for name in sorted(cfv.hashers):
+            if name == ChunkHasher.name:
+                continue
+            start, size = time.time(), 0
+            for filename in filenames:
+                size += cfv._getfilechecksum(filename, cfv.hashers[name])[1]
+            _benchReport(name, len(filenames), size, time.time() - start)
+    finally:
+        cfv.cdup()
+    for name in sorted(cfv._hashermodules):
+        if name not in cfv.hashers:
+            print u"{0:<12} needs the {1} module".format(
+                name, cfv._hashermodules[name])
+
+# sha1 of a file read in 64 KiB blocks, as cfv hashed files beyond 2 GiB
+def _readSha1(filename):
+    hasher, size = hashlib.sha1(), 0
+    with open(filename, 'rb') as fd:
+        for block in iter(lambda: fd.read(2**16), ''):
+            hasher.update(block)
+            size += len(block)
+    return hasher.digest(), size
+
+# bytes of physical memory, None if unknown
+def physicalMemory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# hashing throughput of a file of each of the given sizes, written to DIR:
+# mapped in windows by cfv vs. read in blocks, from the disk and from the
+# page cache if the file fits into the memory
+def benchMmap(args):
+    filename = os.path.join(args.directory, u".dataverifier-bench")
+    block = os.urandom(2**20)
+    memory = physicalMemory()
+    try:
+        for size in args.sizes:
+            with open(filename, 'wb') as fd:
+                for i in xrange(size):
+                    fd.write(block)
+                fd.flush()
+                os.fsync(fd.fileno())
+            print u"{0} MiB".format(size)
+            states = ("disk", "cached")
+            if memory is None or size * 2**20 > memory:
+                # a second pass would read from the disk again
+                print u"larger than the memory, not measured cached"
+                states = ("disk",)
+            for label, hashFile in (("mmap", cfv._getfilesha1),
+                                    ("read", _readSha1)):
+                evictFile(filename)
+                for state in states:
+                    start = time.time()
+                    hashFile(filename)
+                    _benchReport(u"{0} {1}".format(label, state), 1,
+                                 size * 2**20, time.time() - start)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+# benchmark name -> function
+benchmarks = {
+    "order": benchOrder,
+    "readmode": benchReadMode,
+    "digest": benchDigest,
+    "mmap": benchMmap,
+}
+
+## commands ##
+
+def doctest(dummy):
+    import doctest
+    doctest.testmod()
+
+# argparse type of options taking a count of at least 1
+def _positiveInt(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(u"'{0}' is not a positive integer"
+                                         .format(value))
+    return number
+
+# collects --exclude and --include rules in the order given
+class _RuleAction(argparse.Action):
+    def __call__(s, parser, namespace, values, option_string = None):
+        rules = getattr(namespace, s.dest) or []
+        rules.append((s.const, values.decode(sys.getfilesystemencoding())))
+        setattr(namespace, s.dest, rules)
+
+def _addRuleArguments(parser):
+    parser.add_argument("--exclude", dest = "rules", action = _RuleAction,
+                        const = Rules.EXCLUDE, default = [],
+                        metavar = "PATTERN",
+                        help = ("do not monitor paths matching the glob "
+                                "PATTERN, e.g. '*.tmp', 'cache/' (directories "
+                                "only), 'build/**/*.o', or the regular "
+                                "expression following 're:'; kept in the DB"))
+    parser.add_argument("--include", dest = "rules", action = _RuleAction,
+                        const = Rules.INCLUDE, metavar = "PATTERN",
+                        help = ("monitor paths matching PATTERN even if "
+                                "excluded"))
+
+# parses '[PATH=]N' options into values by device and the one for devices
+# without, N converted by 'convert'
+def _deviceLimits(options, what, convert = int):
+    limits, default = dict(), None
+    for option in options:
+        path, sep, value = option.rpartition("=")
+        try:
+            value = convert(value)
+        except ValueError:
+            raise MyError(u"Invalid {0} '{1}'!".format(what, option))
+        if path:
+            limits[os.stat(path).st_dev] = value
+        else:
+            default = value
+    return limits, default
+
+# hash engine selected on the command line
+def hashEngine(args):
+    if args.engine == "serial":
+        return SerialHashEngine()
+    if args.engine == "process":
+        return ProcessHashEngine(args.hashers, args.inflight * 2**20)
+    if args.engine == "pipeline":
+        return PipelineHashEngine(args.readers, args.hashers,
+                                  args.inflight * 2**20)
+    limits, default = _deviceLimits(args.concurrency, u"device concurrency")
+    return DeviceHashEngine(limits, default)
+
+# read governor selected on the command line, None if reads are unlimited
+def governor(args):
+    if not (args.maxRate or args.maxFiles or args.backoff):
+        return None
+    mib = lambda value: float(value) * 2**20
+    rates, defaultRate = _deviceLimits(args.maxRate, u"read rate", mib)
+    fileRates, defaultFileRate = _deviceLimits(args.maxFiles, u"file rate",
+                                               float)
+    return Governor(rates, fileRates, defaultRate, defaultFileRate,
+                    args.backoff)
+
+def verify(args):
+    print "verify"
+    if not hasattr(args, 'filename'):
+        return
+
+    if args.merge and (args.walkers != 1 or args.ordered or args.prune):
+        raise MyError(u"--merge walks the tree on its own, it cannot be "
+                      u"combined with --walkers, --ordered or --prune.")
+    db = ChecksumDB.load(args.filename)
+    print "Loaded checksums for {0}.".format(db)
+    if args.defaultType is not None:
+        db.defaultType = cftypeByName(args.defaultType)
+    if args.clearRules:
+        db.rules.clear()
+    for action, rule in args.rules:
+        db.rules.add(action, rule)
+    journal = Journal(Journal.filenameFor(args.filename))
+    if journal.exists() and not args.resume:
+        logging.warning(u"Discarding journal of an interrupted run, "
+                        u"use --resume to continue it.")
+    migrate = None
+    if args.migrate is not None:
+        migrate = cftypeByName(args.migrate)
+        digestName(migrate) # fails for types without file digests
+    digestName(db.defaultType)
+    dirty = None # the sample level checks every file
+    if not args.full and args.level != "sample" and fcntl is not None:
+        dirty = DirtySet(DirtySet.filenameFor(args.filename))
+    samples, samplesFile = None, SampleDigests.filenameFor(args.filename)
+    if args.level == "sample" or os.path.isfile(samplesFile):
+        samples = SampleDigests(samplesFile)
+    chunks = None
+    if args.chunks is not None:
+        chunks = ChunkManifests(ChunkManifests.filenameFor(args.filename))
+        chunks.minSize = args.chunks * 2**20
+    listings = None
+    if args.prune:
+        listings = DirListings(DirListings.filenameFor(args.filename))
+    cfv.readmode = args.readMode
+    cfv.throttle = governor(args)
+    lowerPriority(args.idle, args.nice) # before threads and processes start
+    engine = hashEngine(args)
+    if args.progress:
+        db.progress = Progress(args.progress)
+        db.progress.start()
+    try:
+        db.check(journal, args.resume, args.walkers, args.ordered,
+                 args.rolling, args.order, engine, dirty, listings,
+                 args.merge, migrate, chunks, args.level, samples)
+    finally:
+        if db.progress is not None:
+            db.progress.stop()
+            db.progress = None
+        engine.close()
+        if chunks is not None:
+            chunks.close()
+        if samples is not None:
+            samples.close()
+    if cfv.throttle is not None:
+        logging.info(u"Reads were throttled for {0:.1f} s in total."
+                     .format(cfv.throttle.waited))
+    db.store(args.filename, args.format) # replace with updated db
+    journal.remove()
+    if listings is not None:
+        listings.replace()
+        listings.close()
+    if dirty is not None:
+        dirty.release()
+
+# records changes in the tree of a DB for the next verify, see watchTree()
+def watch(args):
+    db = ChecksumDB.load(args.filename)
+    try:
+        watchTree(db, DirtySet(DirtySet.filenameFor(args.filename)))
+    except KeyboardInterrupt:
+        logging.info(u"Stopped watching, the next verify walks the whole "
+                     u"tree.")
+
+# parses existing checksum files and generates a database from them
+# TODO: process checksum files in parallel
+def create(args):
+    if (   not hasattr(args, 'directory')
+        or not hasattr(args, 'filename')
+        or not hasattr(args, 'pattern')):
+        return
+
+    directory, pattern, filename = args.directory, args.pattern, args.filename
+    msg = "Creating DB from files in '{0}' with pattern '{1}'. Saving to '{2}'.".\
+        format(directory, pattern.pattern, filename)
+    print msg, "continue ? [Yn]"
+    answer = sys.stdin.readline()
+    if len(answer) > 1:
+        return 1
+
+    rules = Rules()
+    for action, rule in args.rules:
+        rules.add(action, rule)
+    db = ChecksumDB(directory, pattern, rules)
+    if args.defaultType is not None:
+        db.defaultType = cftypeByName(args.defaultType)
+    db.store(filename, args.format)
+
+def bench(args):
+    return benchmarks[args.suite](args)
 
 def logFormatter():
     fmtr = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s',
@@ -418,7 +3987,7 @@ def main():
                                help = ("working directory (default: "
                                        "'%(default)s')"))
     parser_create.add_argument("-p", "--pattern", dest = "pattern",
-                               default = r".*\.sha|.*\.md5",
+                               default = r".*\.sha|.*\.md5|.*\.b2|.*\.xxh64",
                                metavar = "REGEX",
                                help = ("regular expression pattern of checksum "
                                        "files (default: '%(default)s')"))
@@ -427,6 +3996,18 @@ def main():
                                metavar = "FILENAME",
                                help = ("output filename for checksum database "
                                        "(default: '%(default)s')"))
+    parser_create.add_argument("--format", dest = "format",
+                               default = "pickle",
+                               choices = sorted(dbFormats),
+                               help = ("storage format of the checksum database "
+                                       "(default: '%(default)s')"))
+    parser_create.add_argument("--default-type", dest = "defaultType",
+                               default = None, metavar = "TYPE",
+                               help = ("checksum type new and modified files "
+                                       "get, e.g. sha1, md5, b2sum (BLAKE2b) "
+                                       "or xxh64 (fast, not cryptographic); "
+                                       "kept in the DB (default: sha1)"))
+    _addRuleArguments(parser_create)
 
     parser_verify = subparsers.add_parser("verify")
     parser_verify.description = ("Verify a directory structure based on an "
@@ -438,6 +4019,204 @@ def main():
                                metavar = "FILENAME",
                                help = ("filename for checksum database to update "
                                        "(default: '%(default)s')"))
+    parser_verify.add_argument("--format", dest = "format",
+                               default = None,
+                               choices = sorted(dbFormats),
+                               help = ("convert the checksum database to this "
+                                       "storage format, e.g. to import a "
+                                       "pickled DB into SQLite (default: keep "
+                                       "the current format)"))
+    parser_verify.add_argument("--resume", dest = "resume",
+                               action = "store_true", default = False,
+                               help = ("continue an interrupted run from its "
+                                       "journal, skipping files done already"))
+    parser_verify.add_argument("--walkers", dest = "walkers", type = int,
+                               default = 1, metavar = "N",
+                               help = ("list up to N directories concurrently, "
+                                       "for slow metadata and huge trees "
+                                       "(default: %(default)s)"))
+    parser_verify.add_argument("--ordered", dest = "ordered",
+                               action = "store_true", default = False,
+                               help = ("walk the tree in sorted, reproducible "
+                                       "order"))
+    parser_verify.add_argument("--rolling", dest = "rolling",
+                               type = _positiveInt,
+                               default = None, metavar = "N",
+                               help = ("rolling scrub: verify the 1/N of the "
+                                       "data verified longest ago, check the "
+                                       "rest by file system metadata only"))
+    parser_verify.add_argument("--order", dest = "order",
+                               default = "inode",
+                               choices = ("walk", "inode", "physical"),
+                               help = ("order in which files are read, "
+                                       "inode: by inode number, physical: "
+                                       "by location on disk, at the cost of "
+                                       "an open and an ioctl per file, for "
+                                       "spinning disks; see bench order "
+                                       "(default: '%(default)s')"))
+    parser_verify.add_argument("--engine", dest = "engine",
+                               default = "device",
+                               choices = ("serial", "device", "process",
+                                          "pipeline"),
+                               help = ("how files are hashed, device: "
+                                       "different devices concurrently, "
+                                       "process: by a pool of processes, "
+                                       "for storage faster than one core, "
+                                       "pipeline: reader threads feed "
+                                       "hasher threads, overlapping I/O "
+                                       "and hashing (default: '%(default)s')"))
+    parser_verify.add_argument("--hashers", dest = "hashers", type = int,
+                               default = None, metavar = "N",
+                               help = ("number of processes of the process "
+                                       "engine (default: number of cores), "
+                                       "hasher threads of the pipeline engine "
+                                       "(default: 2)"))
+    parser_verify.add_argument("--readers", dest = "readers", type = int,
+                               default = 1, metavar = "N",
+                               help = ("number of files the pipeline engine "
+                                       "reads concurrently (default: "
+                                       "%(default)s)"))
+    parser_verify.add_argument("--inflight", dest = "inflight", type = int,
+                               default = 256, metavar = "MIB",
+                               help = ("MiB of files the process engine "
+                                       "hashes ahead, of buffers the pipeline "
+                                       "engine reads ahead (default: "
+                                       "%(default)s)"))
+    parser_verify.add_argument("--read-mode", dest = "readMode",
+                               default = "default", choices = cfv.READMODES,
+                               help = ("how files are read, default: through "
+                                       "the page cache, fadvise: dropping "
+                                       "the pages read from the cache, evict: "
+                                       "dropping cached pages of a file "
+                                       "before reading it, so it is read "
+                                       "from the disk, direct: bypassing the "
+                                       "cache with O_DIRECT where supported "
+                                       "(default: '%(default)s')"))
+    parser_verify.add_argument("--max-rate", dest = "maxRate",
+                               action = "append", default = [],
+                               metavar = "[PATH=]MIB",
+                               help = ("read at most MIB MiB per second from "
+                                       "the device PATH is on, or from any "
+                                       "device without PATH"))
+    parser_verify.add_argument("--max-files", dest = "maxFiles",
+                               action = "append", default = [],
+                               metavar = "[PATH=]N",
+                               help = ("read at most N files per second from "
+                                       "the device PATH is on, or from any "
+                                       "device without PATH"))
+    parser_verify.add_argument("--backoff", dest = "backoff",
+                               action = "store_true", default = False,
+                               help = ("slow down reading from a device while "
+                                       "its read latency is up, e.g. due to "
+                                       "other load"))
+    parser_verify.add_argument("--idle", dest = "idle",
+                               action = "store_true", default = False,
+                               help = ("read in the idle I/O scheduling "
+                                       "class, only when no one else uses "
+                                       "the disk (Linux)"))
+    parser_verify.add_argument("--nice", dest = "nice", type = int,
+                               default = 0, metavar = "N",
+                               help = ("increase the CPU niceness by N"))
+    parser_verify.add_argument("--concurrency", dest = "concurrency",
+                               action = "append", default = [],
+                               metavar = "[PATH=]N",
+                               help = ("read up to N files concurrently from "
+                                       "the device PATH is on, or from any "
+                                       "device without PATH (default: 1 for "
+                                       "spinning disks, 4 for others)"))
+
+    _addRuleArguments(parser_verify)
+    parser_verify.add_argument("--clear-rules", dest = "clearRules",
+                               action = "store_true", default = False,
+                               help = ("drop the exclude and include rules kept "
+                                       "in the DB before adding those given"))
+    parser_verify.add_argument("--prune", dest = "prune",
+                               action = "store_true", default = False,
+                               help = ("do not list directories again whose "
+                                       "mtime did not change since the last "
+                                       "run, their files are verified as "
+                                       "scheduled but not checked for "
+                                       "modifications in between"))
+    parser_verify.add_argument("--merge", dest = "merge",
+                               action = "store_true", default = False,
+                               help = ("walk the tree sorted by path and merge "
+                                       "it with the DB in a single pass, "
+                                       "instead of keeping all paths in "
+                                       "memory; for huge trees in sqlite or "
+                                       "mapped DBs"))
+    parser_verify.add_argument("--default-type", dest = "defaultType",
+                               default = None, metavar = "TYPE",
+                               help = ("change the checksum type new and "
+                                       "modified files get, see create"))
+    parser_verify.add_argument("--migrate", dest = "migrate",
+                               default = None, metavar = "TYPE",
+                               help = ("convert the entries verified to the "
+                                       "checksum type TYPE (e.g. sha1, md5, "
+                                       "sfv) in the same pass, new files get "
+                                       "it as well"))
+    parser_verify.add_argument("--chunks", dest = "chunks", type = int,
+                               default = None, metavar = "MIB",
+                               help = ("keep a manifest of 4 MiB chunk digests "
+                                       "for files of at least MIB MiB, "
+                                       "unchanged files are verified by "
+                                       "chunks in parallel, resumed within "
+                                       "a file and mismatches reported by "
+                                       "byte range"))
+    parser_verify.add_argument("--level", dest = "level",
+                               default = "full",
+                               choices = ("meta", "sample", "full"),
+                               help = ("how files not modified are verified, "
+                                       "meta: by stat data only, sample: all "
+                                       "of them by about 1%% of their blocks, "
+                                       "files without stored block digests "
+                                       "once in full, full: hashed when due "
+                                       "(default: '%(default)s'); new and "
+                                       "modified files are hashed in full"))
+    parser_verify.add_argument("--progress", dest = "progress", type = float,
+                               default = None, metavar = "SECONDS",
+                               help = ("log the files and bytes verified, the "
+                                       "rate and the time left every SECONDS "
+                                       "seconds"))
+    parser_verify.add_argument("--full", dest = "full",
+                               action = "store_true", default = False,
+                               help = ("walk the whole tree even if a watch "
+                                       "daemon recorded all changes"))
+
+    parser_watch = subparsers.add_parser("watch")
+    parser_watch.description = ("Record changes in the directory of a "
+                                "checksum database as they happen, so verify "
+                                "checks these instead of walking the whole "
+                                "tree. Runs until interrupted, Linux only.")
+    parser_watch.set_defaults(func = watch)
+    parser_watch.add_argument("-f", "--filename", dest = "filename",
+                              default = u"checksum.db",
+                              metavar = "FILENAME",
+                              help = ("filename of the checksum database "
+                                      "(default: '%(default)s')"))
+
+    parser_bench = subparsers.add_parser("bench")
+    parser_bench.description = ("Measure the throughput of the different "
+                                "ways to read and hash files.")
+    parser_bench.set_defaults(func = bench)
+    parser_bench.add_argument("suite", choices = sorted(benchmarks),
+                              help = ("order: read order of files, "
+                                      "readmode: read modes of verify, "
+                                      "digest: checksum types, these read "
+                                      "all files in DIR; mmap: mapping vs. "
+                                      "reading files written to DIR"))
+    parser_bench.add_argument("-d", "--dir", dest = "directory",
+                              default = os.getcwdu(),
+                              metavar = "DIR",
+                              help = ("directory with test data (default: "
+                                      "'%(default)s')"))
+    parser_bench.add_argument("--sizes", dest = "sizes",
+                              type = lambda sizes: [int(size) for size
+                                                    in sizes.split(",")],
+                              default = [1, 16, 256, 4096],
+                              metavar = "MIB,..",
+                              help = ("file sizes of the mmap suite, e.g. "
+                                      "1,1024,102400 up to 100 GiB "
+                                      "(default: 1,16,256,4096)"))
 
     parser_create = subparsers.add_parser("unittest")
     parser_create.description = "Run all unit tests to verify code integrity."